@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from os import getenv, path
+from compression import open_input
+import generate_bulk
+
+logger = logging.getLogger(__name__)
+
+SRC_DIR = path.dirname(path.abspath(__file__))
+
+DEFAULT_SIZES = "10000,100000,1000000"
+
+# (name, script, extra arguments) of each transform stage, each reads the output of the one before
+STAGES = [
+  ("shopify_products", "shopify_products.py", []),
+  ("bloomreach_generics", "bloomreach_generics.py", ["--pid-props", "handle", "--vid-props", "sku,id"]),
+  ("bloomreach_products", "bloomreach_products.py", ["--shopify-url", "example.myshopify.com"]),
+  ("patch", "patch.py", []),
+]
+
+
+# counts the records and uncompressed bytes of a jsonl file
+def measure_input(fp):
+  records, size = 0, 0
+  with open_input(fp) as file:
+    for line in file:
+      records += 1
+      size += len(line)
+  return records, size
+
+
+# runs a stage script in its own process so its peak RSS is measured on its own
+def run_stage(script, args):
+  start = time.perf_counter()
+  process = subprocess.Popen([sys.executable, path.join(SRC_DIR, script)] + args,
+                             stdout=subprocess.DEVNULL,
+                             env={**os.environ, "LOGLEVEL": "WARNING"})
+  _, status, rusage = os.wait4(process.pid, 0)
+  seconds = time.perf_counter() - start
+  # os.waitstatus_to_exitcode needs python 3.9, a process killed by a signal gets its negative number like Popen
+  process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+  if process.returncode != 0:
+    raise RuntimeError("%s exited with status %s" % (script, process.returncode))
+
+  # ru_maxrss is in kilobytes on linux and bytes on macOS
+  peak_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+  return seconds, peak_rss
+
+
+def benchmark_size(products, work_dir, workers=1, compression=None, generator_args=None):
+  """
+  Generates a synthetic bulk output of the given number of products, unless it already exists in work_dir,
+  and runs every stage over it. Returns a result per stage with its records/s, MB/s of uncompressed input
+  and peak RSS.
+  """
+  generator_args = generator_args or {}
+  # the generator is seeded, so a file generated with the same parameters can be reused
+  params = "_".join("%s%s" % (k, v) for k, v in sorted(generator_args.items()))
+  bulk_fp = path.join(work_dir, "%s_%s_0_shopify_bulk_op.jsonl.gz" % (products, params))
+  if not path.exists(bulk_fp):
+    generate_bulk.main(bulk_fp, products=products, **generator_args)
+
+  results = []
+  fp_in = bulk_fp
+  for i, (name, script, stage_args) in enumerate(STAGES, start=1):
+    fp_out = path.join(work_dir, "%s_%s_%s.jsonl.gz" % (products, i, name))
+    records, size = measure_input(fp_in)
+
+    args = ["--input-file", fp_in, "--output-file", fp_out, "--workers", str(workers)] + stage_args
+    if compression:
+      args += ["--compression", compression]
+    seconds, peak_rss = run_stage(script, args)
+
+    result = {
+      "products": products,
+      "stage": name,
+      "records": records,
+      "input_mb": size / 2**20,
+      "seconds": seconds,
+      "records_per_second": records / seconds,
+      "mb_per_second": size / 2**20 / seconds,
+      "peak_rss_mb": peak_rss / 2**20
+    }
+    logger.info("%(products)s products, %(stage)s: %(records_per_second).0f records/s, %(mb_per_second).1f MB/s, peak RSS %(peak_rss_mb).0f MB", result)
+    results.append(result)
+    fp_in = fp_out
+
+  return results
+
+
+def format_results(results):
+  header = "%10s  %-20s %10s %10s %9s %12s %9s %13s" % ("products", "stage", "records", "input MB", "seconds", "records/s", "MB/s", "peak RSS MB")
+  rows = [header, "-" * len(header)]
+  for r in results:
+    rows.append("%10s  %-20s %10s %10.1f %9.2f %12.0f %9.1f %13.0f" % (
+      r["products"], r["stage"], r["records"], r["input_mb"], r["seconds"],
+      r["records_per_second"], r["mb_per_second"], r["peak_rss_mb"]))
+  return "\n".join(rows)
+
+
+def main(sizes, work_dir, workers=1, compression=None, output_fp=None, generator_args=None):
+  os.makedirs(work_dir, exist_ok=True)
+
+  results = []
+  for products in sizes:
+    results.extend(benchmark_size(products, work_dir, workers, compression, generator_args))
+
+  print(format_results(results))
+
+  if output_fp:
+    with open(output_fp, "w") as file:
+      json.dump(results, file, indent=2)
+    logger.info("Wrote benchmark results to: %s", output_fp)
+
+  return results
+
+
+if __name__ == '__main__':
+  import argparse
+
+  from sys import stdout
+
+  # Define logger
+  loglevel = getenv('LOGLEVEL', 'INFO').upper()
+  logging.basicConfig(
+    stream=stdout,
+    level=loglevel,
+    format="%(name)-12s %(asctime)s %(levelname)-8s %(filename)s:%(funcName)s %(message)s"
+  )
+
+  parser = argparse.ArgumentParser(
+    description="Benchmarks each transform stage over synthetic bulk operation outputs of increasing size, reporting records/s, MB/s of uncompressed input and peak RSS per stage. Generated files are kept in the work directory and reused by later runs."
+  )
+
+  parser.add_argument(
+    "--sizes",
+    help="Comma separated numbers of products to benchmark. Defaults to %s." % DEFAULT_SIZES,
+    type=str,
+    default=getenv("BR_BENCHMARK_SIZES", DEFAULT_SIZES)
+  )
+
+  parser.add_argument(
+    "--work-dir",
+    help="Directory for the generated bulk outputs and stage outputs",
+    type=str,
+    default=getenv("BR_BENCHMARK_DIR"),
+    required=not getenv("BR_BENCHMARK_DIR")
+  )
+
+  parser.add_argument(
+    "--workers",
+    help="Number of worker processes each stage runs with",
+    type=int,
+    default=int(getenv("BR_WORKERS", "1"))
+  )
+
+  parser.add_argument(
+    "--compression",
+    help="Compression of the stage output files: gzip[:level], zstd[:level] or none. Defaults to gzip:6.",
+    type=str,
+    default=getenv("BR_COMPRESSION")
+  )
+
+  parser.add_argument(
+    "--output-file",
+    help="Optional file to save the results to as json",
+    type=str,
+    default=None
+  )
+
+  parser.add_argument("--variants", help="Number of variants per product", type=int, default=3)
+  parser.add_argument("--metafields", help="Number of metafields per product and per variant", type=int, default=2)
+  parser.add_argument("--collections", help="Number of collections per product", type=int, default=2)
+  parser.add_argument("--list-share", help="Share of metafields with a list type, between 0 and 1", type=float, default=0.25)
+
+  args = parser.parse_args()
+
+  main([int(size) for size in args.sizes.split(",")],
+       args.work_dir,
+       workers=args.workers,
+       compression=args.compression,
+       output_fp=args.output_file,
+       generator_args={
+         "variants": args.variants,
+         "metafields": args.metafields,
+         "collections": args.collections,
+         "list_share": args.list_share
+       })
@@ -1,25 +1,35 @@
-import gzip
-import json
-import jsonlines
 import logging
+from functools import partial
 from os import getenv
+from codec import dumps_line, loads
+from compression import open_input, open_output
+from metafields import add_metafield_attributes
+from parallel import map_batches
 
 logger = logging.getLogger(__name__)
 
 
-# TODO: transform to iteratively build file instead of in memory
 def create_products(fp, pid_identifiers = None, vid_identifiers = None):
-  products = []
-  
-  # stream over file and index each object in bulk output
-  with gzip.open(fp, 'rb') as file:
+  return list(iter_products(fp, pid_identifiers, vid_identifiers))
+
+
+# stream over file and transform each aggregated shopify product one at a time
+def iter_products(fp, pid_identifiers = None, vid_identifiers = None):
+  caches = {}
+  with open_input(fp) as file:
     for line in file:
-      products.append(create_product(json.loads(line), pid_identifiers, vid_identifiers))
-  
-  return products
+      yield create_product(loads(line), pid_identifiers, vid_identifiers, caches)
+
+
+# worker for parallel mode, transforms and serializes a batch of raw input lines
+def create_product_lines(lines, pid_identifiers = None, vid_identifiers = None):
+  caches = {}
+  return [dumps_line(create_product(loads(line), pid_identifiers, vid_identifiers, caches)) for line in lines]
 
 
-def create_product(shopify_product, pid_identifiers = None, vid_identifiers = None):
+# caches holds the attribute names, category paths and metafield definitions built so far, so products share them
+#   it is owned by whoever transforms the products, such as a single pass over a file, and without it nothing is shared
+def create_product(shopify_product, pid_identifiers = None, vid_identifiers = None, caches = None):
 
     # elif "collections" in prop:
 
@@ -29,10 +39,13 @@ def create_product(shopify_product, pid_identifiers = None, vid_identifiers = No
     # else:
     #   attributes["sp." + prop] = v
 
+  if caches is None:
+    caches = {}
+
   return {
     "id": create_id(shopify_product, identifiers=pid_identifiers), 
-    "attributes": create_attributes(shopify_product, "sp"), 
-    "variants": create_variants(shopify_product, identifiers=vid_identifiers)
+    "attributes": create_attributes(shopify_product, "sp", caches), 
+    "variants": create_variants(shopify_product, identifiers=vid_identifiers, caches=caches)
     }
 
 
@@ -55,16 +68,16 @@ def create_id(shopify_object, identifiers = None):
   return id
 
 
-def create_variants(shopify_product, identifiers = None):
+def create_variants(shopify_product, identifiers = None, caches = None):
   variants = {}
   if "variants" in shopify_product and shopify_product["variants"]:
     for variant in shopify_product["variants"]:
-      variant = create_variant(variant, identifiers)
+      variant = create_variant(variant, identifiers, caches)
       variants[variant["id"]] = {"attributes": variant["attributes"]}
   return variants
 
 
-def create_variant(shopify_variant, identifiers = None):
+def create_variant(shopify_variant, identifiers = None, caches = None):
 
   # attributes = {}
   # for k,v in shopify_variant.items():
@@ -80,54 +93,68 @@ def create_variant(shopify_variant, identifiers = None):
 
   return {
     "id": create_id(shopify_variant, identifiers),
-    "attributes": create_attributes(shopify_variant, "sv")
+    "attributes": create_attributes(shopify_variant, "sv", caches)
     }
 
 
-def create_attributes(shopify_object, namespace):
-  # TODO: Handle all the different types of metafield value types like arrays, etc
-  # TODO: add namespace
-  # https://shopify.dev/api/admin-graphql/2023-01/objects/metafield#field-metafield-type
+def create_attributes(shopify_object, namespace, caches = None):
+  if caches is None:
+    caches = {}
+
+  # metafield values are decoded according to their type, see metafields.DECODERS
   # https://shopify.dev/apps/custom-data/metafields/types
   attributes = {}
+  names = caches.setdefault("attribute_names." + namespace, {})
   for k,v in shopify_object.items():
     if "variants" in k:
       continue
     if "metafields" in k:
-      for metafield in v:
-        # each metafield key/value added to attributes with namespace
-        attribute_name = namespace + "m." + metafield["namespace"] + "." + metafield["key"]
-        # This is a hacky way of doing this to cover all the list use cases
-        # however, more robust value type mapping should occur based on metafield["type"]
-        if "list" in metafield["type"]:
-          attributes[attribute_name] = json.loads(metafield["value"])
-        else:
-          attributes[attribute_name] = metafield["value"]
+      # each metafield key/value added to attributes with namespace
+      add_metafield_attributes(attributes, namespace, v, caches.setdefault("metafield_definitions", {}))
     elif "collections" in k:
-      attributes["category_paths"] = create_category_paths(v)
+      attributes["category_paths"] = create_category_paths(v, caches.setdefault("category_paths", {}))
     else:
       # each object property added as attribute with namespace
-      attributes[namespace + "." + k] = v
+      attributes[names.get(k) or add_attribute_name(names, namespace, k)] = v
   return attributes
 
 
+# names map a property to its prefixed attribute name, built once per property and shared by every record
+def add_attribute_name(names, namespace, k):
+  name = names[k] = namespace + "." + k
+  return name
+
+
+# category_paths maps the (handle, title) of a collection to its category path, built once and shared by every product in the collection
 # TODO: pass in id and name properties to override defaults
-def create_category_paths(collections):
+def create_category_paths(collections, category_paths = None):
+  if category_paths is None:
+    category_paths = {}
+
   paths = []
   for collection in collections:
-    paths.append([{"id": collection["handle"], "name": collection["title"]}])
+    key = (collection["handle"], collection["title"])
+    path = category_paths.get(key)
+    if path is None:
+      path = category_paths[key] = [{"id": collection["handle"], "name": collection["title"]}]
+    paths.append(path)
   
   return paths
 
 
-def main(fp_in, fp_out, pid_props, vid_props):
-  products = create_products(fp_in, pid_identifiers=pid_props, vid_identifiers=vid_props)
+def main(fp_in, fp_out, pid_props, vid_props, workers=1, compression=None):
+  if workers > 1:
+    func = partial(create_product_lines, pid_identifiers=pid_props, vid_identifiers=vid_props)
+    with open_input(fp_in) as file, open_output(fp_out, compression) as out:
+      for line in map_batches(func, file, workers):
+        out.write(line)
+    return
 
-  with gzip.open(fp_out, 'wb') as out:
-    writer = jsonlines.Writer(out)
+  products = iter_products(fp_in, pid_identifiers=pid_props, vid_identifiers=vid_props)
+
+  with open_output(fp_out, compression) as out:
     for object in products:
-      writer.write(object)
-    writer.close()
+      out.write(dumps_line(object))
 
 
 if __name__ == '__main__':
@@ -179,10 +206,28 @@ if __name__ == '__main__':
     default="sku",
     required=False)
 
+  parser.add_argument(
+    "--workers",
+    help="Number of worker processes to transform products with. Output is identical to the default single process run.",
+    type=int,
+    default=int(getenv("BR_WORKERS", "1")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--compression",
+    help="Compression of the output file: gzip[:level], zstd[:level] or none. Defaults to gzip:6. The compression of the input file is detected automatically.",
+    type=str,
+    default=getenv("BR_COMPRESSION"),
+    required=False
+  )
+
   args = parser.parse_args()
   fp_in = args.input_file
   fp_out = args.output_file
   pid_props= args.pid_props
   vid_props= args.vid_props
+  workers = args.workers
+  compression = args.compression
 
-  main(fp_in, fp_out, pid_props, vid_props)
+  main(fp_in, fp_out, pid_props, vid_props, workers, compression)
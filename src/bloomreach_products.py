@@ -1,122 +1,49 @@
 import logging
-import gzip
-import json
-import jsonlines
+from functools import partial
 from os import getenv
+from codec import dumps_line, loads
+from compression import open_input, open_output
+from mapping import load_mapping
+from parallel import map_batches
 
 logger = logging.getLogger(__name__)
 
-PRODUCT_MAPPINGS = [
-  ["sp.vendor", "brand", lambda x: x],
-  ["sp.descriptionHtml", "description", lambda x: x.strip()],
-  ["sp.title", "title", lambda x: x]
-]
 
+def create_products(fp, shopify_url, mapping_fp=None):
+  return list(iter_products(fp, shopify_url, mapping_fp))
 
-def create_products(fp, shopify_url):
-  products = []
 
-  with gzip.open(fp, 'rb') as file:
+# stream over file and transform each generic product one at a time
+def iter_products(fp, shopify_url, mapping_fp=None):
+  with open_input(fp) as file:
     for line in file:
-      products.append(create_product(json.loads(line), shopify_url))
+      yield create_product(loads(line), shopify_url, mapping_fp)
 
-  return products
 
+# worker for parallel mode, transforms and serializes a batch of raw input lines
+def create_product_lines(lines, shopify_url, mapping_fp=None):
+  return [dumps_line(create_product(loads(line), shopify_url, mapping_fp)) for line in lines]
 
-def create_product(product, shopify_url):
 
-  out_product = {
-    "id": product["id"],
-    "attributes": product["attributes"].copy(),
-    "variants": {}
-  }
+# product and variant attributes are mapped by the rules in a mapping config, see mappings/default.json,
+#   which is compiled once per process on first use
+def create_product(product, shopify_url, mapping_fp=None):
+  return load_mapping(shopify_url, mapping_fp)(product)
 
-  # container for input product attributes
-  in_pa = product["attributes"]
-  
-  # container for the transformed product attributes and variants
-  # these dictionaries will be merged into out_product at the end
-  out_pa = out_product["attributes"]
-
-  out_pa["url"] = f"https://{shopify_url}/products/" + in_pa["sp.handle"]
-
-  if in_pa["sp.status"] == "ACTIVE" and "sp.totalInventory" in in_pa and in_pa["sp.totalInventory"] > 0:
-    out_pa["availability"] = True
-  else:
-    out_pa["availability"] = False
-
-  # set thumb_image from featured image (alternatively, this could be large_image)
-  # https://shopify.dev/api/admin-graphql/2023-01/objects/product#field-product-featuredimage
-  if "sp.featuredImage" in in_pa and in_pa["sp.featuredImage"] and "url" in in_pa["sp.featuredImage"]:
-      out_pa["thumb_image"] = in_pa["sp.featuredImage"]["url"]
-
-  # process product level mappings
-  for mapping in PRODUCT_MAPPINGS:
-    source, dest, func = mapping[0], mapping[1], mapping[2]
-    # handle scenario when pa[source] is false, such as 0
-    if source in in_pa:
-      value = func(in_pa[source])
-      if type(value) == str and value == "":
-        # don't add empty string values
-        pass
-      else:
-        out_pa[dest] = value
-
-  # iterate over each variant
-  for v_id, variant in product["variants"].items():
-
-    # container of input and output variant attributes
-    in_va = variant["attributes"]
-    out_va = variant["attributes"].copy()
-    out_product["variants"][v_id] = {}
-
-    if "sv.compareAtPrice" in in_va and in_va["sv.compareAtPrice"]:
-      if in_va["sv.compareAtPrice"] == in_va["sv.price"]:
-        out_va["price"] = in_va["sv.compareAtPrice"]
-      else:
-        out_va["price"] = in_va["sv.compareAtPrice"]
-        out_va["sale_price"] = in_va["sv.price"]
-    else:
-      out_va["price"] = in_va["sv.price"]
-
-    # set color, size from selectedOptions
-    # TODO: set other options to custom attributes
-    if "sv.selectedOptions" in in_va:
-      if in_va["sv.selectedOptions"] and len(in_va["sv.selectedOptions"]) > 0:
-        for option in in_va["sv.selectedOptions"]:
-          if "name" in option and "value" in option and "Color" in option[
-              "name"]:
-            out_va["color"] = option["value"]
-            # br_va["variants_color"] = option["value"]
-          if "name" in option and "value" in option and "Size" in option[
-              "name"]:
-            out_va["size"] = option["value"]
-
-    out_va["availability"] = False
-    if "sv.availableForSale" in in_va and in_va["sv.availableForSale"]:
-      out_va["availability"] = True
-    else:
-      out_va["availability"] = False
-
-    # set thumb_image (swatch_image isn't a standard shopify concept as far as I can tell)
-    # https://shopify.dev/api/admin-graphql/2023-01/objects/ProductVariant#field-productvariant-image
-    if "sv.image" in in_va and in_va["sv.image"] and "url" in in_va["sv.image"]:
-      out_va["thumb_image"] = in_va["sv.image"]["url"]
-    
-    out_product["variants"][v_id]["attributes"] = out_va
-
-  return out_product
-
-
-def main(fp_in, fp_out, shopify_url):
-  patch = create_products(fp_in, shopify_url)
+
+def main(fp_in, fp_out, shopify_url, workers=1, compression=None, mapping_fp=None):
+  if workers > 1:
+    with open_input(fp_in) as file, open_output(fp_out, compression) as out:
+      for line in map_batches(partial(create_product_lines, shopify_url=shopify_url, mapping_fp=mapping_fp), file, workers):
+        out.write(line)
+    return
+
+  patch = iter_products(fp_in, shopify_url, mapping_fp)
 
   # write JSONLines
-  with gzip.open(fp_out, "wb") as file:
-    writer = jsonlines.Writer(file)
+  with open_output(fp_out, compression) as file:
     for object in patch:
-      writer.write(object)
-    writer.close()
+      file.write(dumps_line(object))
 
 
 if __name__ == '__main__':
@@ -161,9 +88,36 @@ if __name__ == '__main__':
     required=not getenv("BR_SHOPIFY_URL")
   )
 
+  parser.add_argument(
+    "--workers",
+    help="Number of worker processes to transform products with. Output is identical to the default single process run.",
+    type=int,
+    default=int(getenv("BR_WORKERS", "1")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--compression",
+    help="Compression of the output file: gzip[:level], zstd[:level] or none. Defaults to gzip:6. The compression of the input file is detected automatically.",
+    type=str,
+    default=getenv("BR_COMPRESSION"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--mapping-file",
+    help="File path of a json mapping config of product and variant attributes. Defaults to src/mappings/default.json.",
+    type=str,
+    default=getenv("BR_MAPPING_FILE"),
+    required=False
+  )
+
   args = parser.parse_args()
   fp_in = args.input_file
   fp_out = args.output_file
   shopify_url = args.shopify_url
+  workers = args.workers
+  compression = args.compression
+  mapping_fp = args.mapping_file
 
-  main(fp_in, fp_out, shopify_url)
+  main(fp_in, fp_out, shopify_url, workers, compression, mapping_fp)
@@ -0,0 +1,65 @@
+"""
+JSON codec shared by every stage.
+
+Uses orjson when it is installed, then ujson, falling back to the standard library json module.
+Set BR_JSON_CODEC to `orjson`, `ujson` or `json` to force a codec, for instance to confirm
+output is byte identical with and without a fast codec installed.
+
+Output lines are compact (no whitespace after separators) and UTF-8 encoded with every codec.
+This differs byte for byte from the ", " and ": " separators written by jsonlines before, orjson
+has no option for them, so the compact form is used everywhere rather than only with orjson.
+The one known difference is floats in exponent notation, e.g. 1e16 from orjson vs 1e+16 from json.
+"""
+import json
+import logging
+from os import getenv
+
+logger = logging.getLogger(__name__)
+
+CODECS = ["orjson", "ujson", "json"]
+
+
+def load_codec(name):
+  if name == "orjson":
+    import orjson
+
+    def dumps_line(object):
+      return orjson.dumps(object, option=orjson.OPT_APPEND_NEWLINE)
+
+    return orjson.loads, dumps_line
+
+  if name == "ujson":
+    import ujson
+
+    def dumps_line(object):
+      return (ujson.dumps(object, ensure_ascii=False, escape_forward_slashes=False) + "\n").encode("utf-8")
+
+    return ujson.loads, dumps_line
+
+  if name == "json":
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def dumps_line(object):
+      return (encoder.encode(object) + "\n").encode("utf-8")
+
+    return json.loads, dumps_line
+
+  raise ValueError("Invalid JSON codec: %s" % name)
+
+
+def select_codec(requested=None):
+  if requested:
+    return requested, load_codec(requested)
+
+  for name in CODECS:
+    try:
+      return name, load_codec(name)
+    except ImportError:
+      continue
+
+
+# loads accepts the raw bytes of a line so no decode to str is needed
+# dumps_line returns the UTF-8 bytes of a single JSONL line, including the trailing newline
+CODEC, (loads, dumps_line) = select_codec(getenv("BR_JSON_CODEC"))
+logger.debug("Using JSON codec: %s", CODEC)
+
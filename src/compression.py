@@ -0,0 +1,99 @@
+import gzip
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# compression settings are strings of the form codec[:level], e.g. gzip:6, zstd:3 or none
+DEFAULT_COMPRESSION = "gzip:6"
+
+DEFAULT_LEVELS = {
+  "gzip": 6,
+  "zstd": 3
+}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def parse_compression(compression=None):
+  if not compression:
+    compression = DEFAULT_COMPRESSION
+
+  codec, _, level = compression.lower().partition(":")
+  if codec == "none":
+    return codec, None
+  if codec not in DEFAULT_LEVELS:
+    raise ValueError("Invalid compression: %s" % compression)
+  if not level:
+    return codec, DEFAULT_LEVELS[codec]
+
+  try:
+    return codec, int(level)
+  except ValueError:
+    raise ValueError("Invalid compression level: %s" % compression) from None
+
+
+def check_compression(compression=None, codecs=("gzip", "zstd", "none")):
+  """
+  Validates a codec[:level] setting before anything is written with it, raising a ValueError when it is invalid
+  or not one of codecs, and an ImportError when it is zstd without the zstandard package installed.
+  """
+  codec, _ = parse_compression(compression)
+  if codec not in codecs:
+    raise ValueError("Compression must be one of %s, found: %s" % (", ".join(codecs), compression))
+  if codec == "zstd":
+    import_zstandard()
+
+
+# zstandard is an optional dependency, only needed when zstd is selected or read
+def import_zstandard():
+  try:
+    import zstandard
+  except ImportError:
+    raise ImportError("zstd compression requires the zstandard package, install it with: pip install zstandard") from None
+  return zstandard
+
+
+def open_output(fp, compression=None):
+  """
+  Opens a file for binary writing, compressed according to a codec[:level] setting.
+
+  Defaults to gzip at level 6, which is much faster than gzip's default of 9 at a similar size for jsonl.
+  """
+  codec, level = parse_compression(compression)
+
+  if codec == "gzip":
+    return gzip.open(fp, "wb", compresslevel=level)
+  if codec == "zstd":
+    zstandard = import_zstandard()
+    return zstandard.open(fp, "wb", cctx=zstandard.ZstdCompressor(level=level))
+  return open(fp, "wb")
+
+
+def detect_compression(fp):
+  with open(fp, "rb") as file:
+    magic = file.read(4)
+
+  if magic.startswith(GZIP_MAGIC):
+    return "gzip"
+  if magic.startswith(ZSTD_MAGIC):
+    return "zstd"
+  return "none"
+
+
+def open_input(fp):
+  """
+  Opens a file for binary reading, detecting whether it is gzip, zstd or uncompressed from its first bytes.
+  """
+  codec = detect_compression(fp)
+
+  if codec == "gzip":
+    return gzip.open(fp, "rb")
+  if codec == "zstd":
+    zstandard = import_zstandard()
+    # buffered so the file can be iterated line by line like the other codecs,
+    #   reading across frames so concatenated files, such as merged export shards, are read whole
+    reader = zstandard.ZstdDecompressor().stream_reader(open(fp, "rb"), read_across_frames=True, closefd=True)
+    return io.BufferedReader(reader)
+  return open(fp, "rb")
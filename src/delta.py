@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import logging
+from os import getenv, path, replace
+from codec import dumps_line, loads
+from compression import open_input, open_output
+
+logger = logging.getLogger(__name__)
+
+
+# index files hold a line per product of the patch op path and a hash of the serialized op
+def load_index(index_fp):
+  index = {}
+  if not path.exists(index_fp):
+    return index
+
+  with gzip.open(index_fp, "rt", encoding="utf-8") as file:
+    for line in file:
+      op_path, digest = line.rstrip("\n").split("\t")
+      index[op_path] = digest
+
+  return index
+
+
+def hash_line(line):
+  return hashlib.blake2b(line, digest_size=16).hexdigest()
+
+
+def pending_index_fp(index_fp):
+  return index_fp + ".pending"
+
+
+# path of the product an operation path belongs to, e.g. /products/abc for /products/abc/attributes/price
+def op_product_path(op_path):
+  return "/".join(op_path.split("/", 3)[:3])
+
+
+def create_delta(patch_fp, delta_fp, index_fp, compression=None, remove_scope=None):
+  """
+  Compares each add product operation in a full patch against the index of the last successful run,
+  writing only the operations of new or changed products, plus a remove operation for every
+  product that is no longer in the patch, to a delta patch.
+
+  When a set of product paths is passed as remove_scope, operations that are no longer in the patch
+  are only removed if their product is in it, and are otherwise dropped from the index.
+
+  The index for the current patch is written next to the existing index with a .pending suffix
+  and only replaces it once commit_index is called after the delta feed succeeds.
+
+  Returns a tuple of the number of add and remove operations in the delta patch.
+  """
+  previous = load_index(index_fp)
+  adds, removes = 0, 0
+
+  with open_input(patch_fp) as file, \
+      open_output(delta_fp, compression) as out, \
+      gzip.open(pending_index_fp(index_fp), "wt", encoding="utf-8") as index:
+    for line in file:
+      op_path = loads(line)["path"]
+      digest = hash_line(line)
+      index.write(op_path + "\t" + digest + "\n")
+
+      if previous.pop(op_path, None) != digest:
+        out.write(line)
+        adds += 1
+
+    # anything left over from the previous run is no longer in the catalog
+    for op_path in previous:
+      if remove_scope is not None and op_product_path(op_path) not in remove_scope:
+        continue
+      out.write(dumps_line({"op": "remove", "path": op_path}))
+      removes += 1
+
+  logger.info("Delta patch has %s add and %s remove operations: %s", adds, removes, delta_fp)
+  return adds, removes
+
+
+# writes the index of a full patch, used when there isn't an index from a previous run yet
+def create_index(patch_fp, index_fp):
+  with open_input(patch_fp) as file, \
+      gzip.open(pending_index_fp(index_fp), "wt", encoding="utf-8") as index:
+    for line in file:
+      index.write(loads(line)["path"] + "\t" + hash_line(line) + "\n")
+
+
+def commit_index(index_fp):
+  replace(pending_index_fp(index_fp), index_fp)
+  logger.info("Updated product hash index: %s", index_fp)
+
+
+if __name__ == '__main__':
+  import argparse
+
+  from sys import stdout
+
+  # Define logger
+  loglevel = getenv('LOGLEVEL', 'INFO').upper()
+  logging.basicConfig(
+    stream=stdout,
+    level=loglevel,
+    format="%(name)-12s %(asctime)s %(levelname)-8s %(filename)s:%(funcName)s %(message)s"
+  )
+
+  parser = argparse.ArgumentParser(
+    description="Creates a delta patch from a full Bloomreach patch, containing only the products that were added or changed, and remove operations for products that were deleted, since the last successful run. The product hash index of the current patch is saved as pending and should be committed with --commit-index once the delta feed succeeds."
+  )
+
+  parser.add_argument(
+    "--input-file",
+    help="File path of the full Bloomreach patch jsonl",
+    type=str,
+    default=getenv("BR_INPUT_FILE"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--output-file",
+    help="Filename of the delta patch jsonl file",
+    type=str,
+    default=getenv("BR_OUTPUT_FILE"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--index-file",
+    help="File path of the product hash index from the last successful run",
+    type=str,
+    default=getenv("BR_INDEX_FILE"),
+    required=not getenv("BR_INDEX_FILE")
+  )
+
+  parser.add_argument(
+    "--compression",
+    help="Compression of the delta patch file: gzip[:level] or none. Defaults to gzip:6.",
+    type=str,
+    default=getenv("BR_COMPRESSION"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--commit-index",
+    help="Replace the index with the pending index of the last delta patch instead of creating a delta patch",
+    action="store_true"
+  )
+
+  args = parser.parse_args()
+
+  if args.commit_index:
+    commit_index(args.index_file)
+  else:
+    if not args.input_file or not args.output_file:
+      parser.error("--input-file and --output-file are required to create a delta patch")
+    create_delta(args.input_file, args.output_file, args.index_file, args.compression)
@@ -0,0 +1,204 @@
+import gzip
+import logging
+from functools import partial
+from os import getenv, path
+import bloomreach_generics
+import bloomreach_products
+from codec import dumps_line, loads
+from compression import open_input, open_output
+from delta import commit_index, hash_line, load_index, pending_index_fp
+from patch import create_attribute_ops, product_path
+from projection import PROJECTIONS_DIR
+from shopify_products import consume_products
+
+logger = logging.getLogger(__name__)
+
+# a fast sync only exports the fields price and availability depend on
+FAST_SYNC_PROJECTION_FP = path.join(PROJECTIONS_DIR, "fast_sync.json")
+
+# attributes kept up to date by a fast sync, the shopify fields it exports and the mapped attributes set from them
+PRODUCT_ATTRIBUTES = ["availability", "sp.status", "sp.totalInventory"]
+VARIANT_ATTRIBUTES = ["price", "sale_price", "availability", "sv.price", "sv.compareAtPrice", "sv.inventoryQuantity", "sv.availableForSale"]
+
+
+# products run through the same generic and mapping transforms as a full run, so ids and the price
+#   and availability rules stay the same, but only the synced attributes are turned into operations
+#   when a set of product paths is passed, products that aren't in it are skipped
+def iter_attribute_ops(shopify_products, shopify_url, pid_props=None, vid_props=None, mapping_fp=None, product_paths=None):
+  caches = {}
+  for shopify_product in shopify_products:
+    generic_product = bloomreach_generics.create_product(shopify_product, pid_props, vid_props, caches)
+    br_product = bloomreach_products.create_product(generic_product, shopify_url, mapping_fp)
+    if product_paths is not None and product_path(br_product["id"]) not in product_paths:
+      continue
+    yield from create_attribute_ops(br_product, PRODUCT_ATTRIBUTES, VARIANT_ATTRIBUTES)
+
+
+def write_attribute_ops(products, patch_fp, shopify_url, pid_props=None, vid_props=None, compression=None, mapping_fp=None, product_paths=None):
+  count = 0
+  with open_output(patch_fp, compression) as out:
+    for op in iter_attribute_ops(products, shopify_url, pid_props, vid_props, mapping_fp, product_paths):
+      out.write(dumps_line(op))
+      count += 1
+  return count
+
+
+def load_product_paths(product_index_fp):
+  """
+  Reads the product paths of the product hash index of the last successful delta full run, which are the
+  products in the catalog. Returns None when there isn't an index, so every product is synced.
+  """
+  if not product_index_fp or not path.exists(product_index_fp):
+    logger.warning("No product hash index of a full delta run at %s, syncing every product in the export", product_index_fp)
+    return None
+  return set(load_index(product_index_fp))
+
+
+def create_attribute_patch(shopify_jsonl_fp, patch_fp, shopify_url, pid_props=None, vid_props=None, compression=None, mapping_fp=None, product_paths=None):
+  """
+  Writes an attribute level patch of the price and availability attributes of every product in a
+  fast sync bulk output, or a callable streaming its lines, and returns the number of operations.
+
+  When a set of product paths is passed, such as those of load_product_paths, only the products in it are patched,
+  so products created since the last full run are left for the next one to add.
+
+  Like a full run, products that don't follow their children fall back to the spilled index.
+  """
+  write = partial(write_attribute_ops,
+                  patch_fp=patch_fp,
+                  shopify_url=shopify_url,
+                  pid_props=pid_props,
+                  vid_props=vid_props,
+                  compression=compression,
+                  mapping_fp=mapping_fp,
+                  product_paths=product_paths)
+  count = consume_products(shopify_jsonl_fp, write, spill_dir=path.dirname(patch_fp) or None)
+
+  logger.info("Wrote %s attribute operations to: %s", count, patch_fp)
+  return count
+
+
+# attribute hash index of the fast syncs of a catalog, kept in the state directory
+def attribute_index_path(state_dir, catalog_name):
+  return f"{state_dir}/{catalog_name}_attribute_hashes.tsv.gz"
+
+
+def rebuild_attribute_index(patch_fp, index_fp):
+  """
+  Rewrites the attribute hash index of the fast syncs from the full patch of a full run, once its feed succeeded.
+
+  The full run may have set attributes to other values than the last fast sync sent, so the index is realigned with
+  what the catalog now holds. Otherwise a value going back to what an earlier fast sync sent would hash the same and
+  be skipped, leaving the value of the full run in the catalog.
+  """
+  count = 0
+  with open_input(patch_fp) as file, \
+      gzip.open(pending_index_fp(index_fp), "wt", encoding="utf-8") as index:
+    for line in file:
+      op = loads(line)
+      product = {"id": op["path"][len("/products/"):].replace("~1", "/"), **op["value"]}
+      for attribute_op in create_attribute_ops(product, PRODUCT_ATTRIBUTES, VARIANT_ATTRIBUTES):
+        index.write(attribute_op["path"] + "\t" + hash_line(dumps_line(attribute_op)) + "\n")
+        count += 1
+
+  commit_index(index_fp)
+  logger.info("Rebuilt %s fast sync attribute hashes from the full patch: %s", count, index_fp)
+
+
+def main(fp_in, fp_out, shopify_url, pid_props=None, vid_props=None, compression=None, mapping_fp=None, product_index_fp=None):
+  product_paths = load_product_paths(product_index_fp) if product_index_fp else None
+  create_attribute_patch(fp_in, fp_out, shopify_url, pid_props, vid_props, compression, mapping_fp, product_paths)
+
+
+if __name__ == '__main__':
+  import argparse
+
+  from sys import stdout
+
+  # Define logger
+  loglevel = getenv('LOGLEVEL', 'INFO').upper()
+  logging.basicConfig(
+    stream=stdout,
+    level=loglevel,
+    format="%(name)-12s %(asctime)s %(levelname)-8s %(filename)s:%(funcName)s %(message)s"
+  )
+
+  parser = argparse.ArgumentParser(
+    description="Transforms the Shopify bulk output of a fast sync export into a Bloomreach Discovery catalog patch of attribute level `add` operations, only updating the price and availability attributes of each product and variant."
+  )
+
+  parser.add_argument(
+    "--input-file",
+    help="File path of the Shopify bulk output jsonl",
+    type=str,
+    default=getenv("BR_INPUT_FILE"),
+    required=not getenv("BR_INPUT_FILE")
+  )
+
+  parser.add_argument(
+    "--output-file",
+    help="Filename of output jsonl file",
+    type=str,
+    default=getenv("BR_OUTPUT_FILE"),
+    required=not getenv("BR_OUTPUT_FILE")
+  )
+
+  parser.add_argument(
+    "--shopify-url",
+    help="Hostname of the shopify Shop, e.g. xyz.myshopify.com.",
+    type=str,
+    default=getenv("BR_SHOPIFY_URL"),
+    required=not getenv("BR_SHOPIFY_URL")
+  )
+
+  parser.add_argument(
+    "--pid-props",
+    help="Comma separated property names to use to resolve a shopify product property to Bloomreach product identifier. Must match the full runs, usually 'handle'.",
+    type=str,
+    default="handle",
+    required=False
+  )
+
+  parser.add_argument(
+    "--vid-props",
+    help="Comma separated property names to use to resolve a shopify variant property to Bloomreach variant identifier. Must match the full runs, usually 'sku,id'.",
+    type=str,
+    default="sku,id",
+    required=False
+  )
+
+  parser.add_argument(
+    "--compression",
+    help="Compression of the output file: gzip[:level], zstd[:level] or none. Defaults to gzip:6. The compression of the input file is detected automatically.",
+    type=str,
+    default=getenv("BR_COMPRESSION"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--mapping-file",
+    help="File path of a json mapping config of product and variant attributes. Defaults to src/mappings/default.json.",
+    type=str,
+    default=getenv("BR_MAPPING_FILE"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--product-index-file",
+    help="File path of the product hash index of the full delta runs. Only the products in it are patched.",
+    type=str,
+    default=getenv("BR_PRODUCT_INDEX_FILE"),
+    required=False
+  )
+
+  args = parser.parse_args()
+  fp_in = args.input_file
+  fp_out = args.output_file
+  shopify_url = args.shopify_url
+  pid_props = args.pid_props
+  vid_props = args.vid_props
+  compression = args.compression
+  mapping_fp = args.mapping_file
+  product_index_fp = args.product_index_file
+
+  main(fp_in, fp_out, shopify_url, pid_props, vid_props, compression, mapping_fp, product_index_fp)
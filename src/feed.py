@@ -1,10 +1,36 @@
+import gzip
+import hashlib
+import json
 import logging
-import polling
 import requests
-from os import getenv
+from requests.adapters import HTTPAdapter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextvars import copy_context
+from os import getenv, path, remove, replace, stat
+from time import monotonic, sleep
+from compression import detect_compression, open_input
+from poller import poll
 
 logger = logging.getLogger(__name__)
 
+DC_ENDPOINT = "dataconnect/api/v1"
+
+# compressions of a patch the feed API accepts as a request body
+FEED_CODECS = ("gzip", "none")
+
+# failed requests are retried with exponential backoff, in seconds
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_RETRIES = 5
+RETRY_BACKOFF = 2
+MAX_RETRY_DELAY = 60
+
+# seconds to wait for a connection and for the response of a request, so a hung request fails and is retried
+REQUEST_TIMEOUT = (30, 600)
+
+
+class FeedJobError(ValueError):
+  pass
+
 
 def hostname_from_environment(environment="staging"):
   hostnames = {
@@ -17,49 +43,261 @@ def hostname_from_environment(environment="staging"):
   return hostnames[environment]
 
 
+def api_url_from_environment(environment="staging"):
+  hostname = hostname_from_environment(environment)
+  return f"https://{hostname}/{DC_ENDPOINT}"
+
+
+def create_session(concurrency=1):
+  # one pooled connection per concurrent upload
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  return session
+
+
 def patch_catalog(
     patch_fp,
     account_id="",
     environment_name="",
     catalog_name="",
-    token=""):
+    token="",
+    delta=False,
+    chunk_bytes=None,
+    concurrency=4,
+    api_url=None,
+    session=None,
+    stats=None,
+    checkpoint_dir=None):
+  """
+  Sends a patch file to the feed API and waits for the resulting feed jobs to complete.
+
+  By default the patch is sent in a single request, as a full feed with HTTP PUT,
+  or as a delta feed with HTTP PATCH when delta is True.
+
+  When chunk_bytes is set for a delta feed, the patch is split on product boundaries into parts of
+  roughly chunk_bytes uncompressed, which are sent concurrently as separate delta feeds. Failed parts are
+  retried with backoff, and acknowledged parts are recorded in a checkpoint file in checkpoint_dir, which
+  defaults to the directory of the patch. The checkpoint is named after a hash of the catalog url, the part
+  size and the uncompressed patch content, so a rerun sending the same operations resumes where the previous
+  one stopped, whatever the name of its patch file. The parts of feed jobs that fail are dropped from the
+  checkpoint and sent again by the next rerun. A full feed replaces the whole catalog so it is always sent
+  in a single request.
 
-  dc_endpoint = "dataconnect/api/v1"
+  api_url defaults to the Bloomreach API for the environment, and may point at a local stand-in.
 
-  hostname = hostname_from_environment(environment_name)
+  When a stats dict is passed, it is updated with the seconds, bytes and feed jobs of the upload,
+  and the seconds and polls spent waiting for the feed jobs.
+  """
+  if api_url is None:
+    api_url = api_url_from_environment(environment_name)
+  if session is None:
+    session = create_session(concurrency)
 
   account_endpoint = f"accounts/{account_id}"
   catalog_endpoint = f"catalogs/{catalog_name}"
 
-  url = f"https://{hostname}/{dc_endpoint}/{account_endpoint}/{catalog_endpoint}/products"
+  url = f"{api_url}/{account_endpoint}/{catalog_endpoint}/products"
 
   headers = {
     "Content-Type": "application/json-patch+jsonlines",
-    "Content-Encoding": "gzip",
     "Authorization": "Bearer " + token
   }
 
-  feed_job_id = ""
-  with open(patch_fp, 'rb') as payload:
-    response = requests.put(url, data=payload, headers=headers)
-    response.raise_for_status()
+  # the feed API accepts gzip or uncompressed request bodies
+  compression = detect_compression(patch_fp)
+  if compression == "gzip":
+    headers["Content-Encoding"] = "gzip"
+  elif compression not in FEED_CODECS:
+    raise ValueError("Patch file must be gzip compressed or uncompressed, found: %s" % compression)
 
-    logger.info("Feed API: HTTP PUT: %s", response.url)
+  checkpoint_fp = None
+  start = monotonic()
+  if chunk_bytes and delta:
+    fingerprint = patch_fingerprint(url, patch_fp, chunk_bytes)
+    checkpoint_fp = path.join(checkpoint_dir or path.dirname(patch_fp) or ".", "feed_checkpoint_%s.json" % fingerprint[:16])
+    jobs = upload_chunks(session, url, headers, patch_fp, chunk_bytes, concurrency, checkpoint_fp, fingerprint)
+  else:
+    if chunk_bytes:
+      logger.warning("A full feed replaces the whole catalog, sending it in a single request")
+
+    # a full feed replaces the whole catalog, a delta feed only applies the patch operations
+    method = "PATCH" if delta else "PUT"
+    response = send_with_retry(session, method, url, headers, data_fp=patch_fp)
+
+    logger.info("Feed API: HTTP %s: %s", method, response.url)
     logger.info("Feed Job response: %s", response.json())
-    job_id = response.json()["jobId"]
+    jobs = {"0": response.json()["jobId"]}
 
-  polling.poll(lambda: br_check_status(job_id=job_id, environment_name=environment_name, token=token), step=10, timeout=7200)
-  
+  upload_seconds = monotonic() - start
+
+  start = monotonic()
+  job_polls = 0
+  failed = []
+  for index in sorted(jobs, key=int):
+    job_id = jobs[index]
+    try:
+      job_polls += poll(lambda: br_check_status(job_id=job_id, environment_name=environment_name, token=token, api_url=api_url, session=session),
+           step=2, max_step=60, timeout=7200, name="Feed job %s" % job_id)["polls"]
+    except FeedJobError:
+      failed.append(index)
+
+  if stats is not None:
+    stats["uploadSeconds"] = upload_seconds
+    stats["uploadBytes"] = stat(patch_fp).st_size
+    stats["uploadJobs"] = len(jobs)
+    stats["jobWaitSeconds"] = monotonic() - start
+    stats["jobWaitPolls"] = job_polls
+
+  if failed:
+    failed_jobs = [jobs[index] for index in failed]
+    if checkpoint_fp is not None:
+      # the parts of failed jobs are sent again on rerun, instead of polling the same failed jobs
+      for index in failed:
+        del jobs[index]
+      save_checkpoint(checkpoint_fp, fingerprint, jobs)
+      logger.warning("Dropped %s parts of failed feed jobs from the checkpoint: %s", len(failed), checkpoint_fp)
+    raise FeedJobError("Feed jobs did not complete successfully: %s" % ", ".join(failed_jobs))
+
+  if checkpoint_fp is not None and path.exists(checkpoint_fp):
+    remove(checkpoint_fp)
+
+
+def send_with_retry(session, method, url, headers, data=None, data_fp=None, retries=MAX_RETRIES, backoff=RETRY_BACKOFF, timeout=REQUEST_TIMEOUT):
+  """
+  Sends a request body, either bytes in data or the contents of the file at data_fp,
+  retrying connection errors, timeouts and retryable HTTP statuses with exponential backoff.
+  """
+  for attempt in range(retries + 1):
+    try:
+      if data_fp is not None:
+        with open(data_fp, 'rb') as payload:
+          response = session.request(method, url, data=payload, headers=headers, timeout=timeout)
+      else:
+        response = session.request(method, url, data=data, headers=headers, timeout=timeout)
+
+      if response.status_code not in RETRY_STATUSES or attempt == retries:
+        response.raise_for_status()
+        return response
+      error = "HTTP %s" % response.status_code
+    except (requests.ConnectionError, requests.Timeout) as e:
+      if attempt == retries:
+        raise
+      error = e
+
+    delay = min(backoff * 2 ** attempt, MAX_RETRY_DELAY)
+    logger.warning("Feed API: HTTP %s failed (%s), retrying in %ss", method, error, delay)
+    sleep(delay)
+
+
+# split a patch on product boundaries into gzip compressed parts of roughly chunk_bytes uncompressed
+def iter_chunks(patch_fp, chunk_bytes):
+  index, lines, size = 0, [], 0
+  with open_input(patch_fp) as file:
+    for line in file:
+      lines.append(line)
+      size += len(line)
+      if size >= chunk_bytes:
+        yield index, gzip.compress(b"".join(lines), compresslevel=6)
+        index, lines, size = index + 1, [], 0
+
+  if lines:
+    yield index, gzip.compress(b"".join(lines), compresslevel=6)
+
+
+# returns the feed job id of every part by part index
+def upload_chunks(session, url, headers, patch_fp, chunk_bytes, concurrency, checkpoint_fp, fingerprint):
+  jobs = load_checkpoint(checkpoint_fp, fingerprint)
+  if jobs:
+    logger.info("Resuming upload, %s parts already acknowledged", len(jobs))
+
+  headers = dict(headers)
+  headers["Content-Encoding"] = "gzip"
+
+  def acknowledge(future):
+    index = pending.pop(future)
+    response = future.result()
+    jobs[str(index)] = response.json()["jobId"]
+    save_checkpoint(checkpoint_fp, fingerprint, jobs)
+    logger.info("Feed API: part %s acknowledged, job: %s", index, jobs[str(index)])
+
+  # on a failed part, the parts still in flight are finished and the acknowledged ones checkpointed
+  #   before the error is raised, so a rerun doesn't send them again
+  def acknowledge_sent():
+    for future in pending:
+      future.cancel()
+    done, _ = wait(list(pending))
+    for future in done:
+      if not future.cancelled() and future.exception() is None:
+        acknowledge(future)
+
+  pending = {}
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    try:
+      for index, chunk in iter_chunks(patch_fp, chunk_bytes):
+        if str(index) in jobs:
+          continue
 
-def br_check_status(job_id="", environment_name="", token=""):
-  dc_endpoint = "dataconnect/api/v1"
-  hostname = hostname_from_environment(environment_name)
-  url = f"https://{hostname}/{dc_endpoint}/jobs/{job_id}"
+        # chunks are sent in the context of the caller, such as the store of an orchestrated run
+        pending[pool.submit(copy_context().run, send_with_retry, session, "PATCH", url, headers, data=chunk)] = index
+
+        # bound the number of compressed parts held in memory
+        if len(pending) >= concurrency * 2:
+          done, _ = wait(pending, return_when=FIRST_COMPLETED)
+          for future in done:
+            acknowledge(future)
+
+      for future in as_completed(list(pending)):
+        acknowledge(future)
+    except BaseException:
+      acknowledge_sent()
+      raise
+
+  return jobs
+
+
+# a patch is resumable as long as neither its catalog, its operations nor the part size changed,
+#   the uncompressed content is hashed as gzip headers differ between otherwise identical patches
+def patch_fingerprint(url, patch_fp, chunk_bytes):
+  digest = hashlib.sha1(f"{url}\n{chunk_bytes}\n".encode("utf-8"))
+  with open_input(patch_fp) as file:
+    for block in iter(lambda: file.read(1024 * 1024), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def load_checkpoint(checkpoint_fp, fingerprint):
+  if not path.exists(checkpoint_fp):
+    return {}
+
+  with open(checkpoint_fp) as file:
+    checkpoint = json.load(file)
+
+  if checkpoint["fingerprint"] != fingerprint:
+    logger.info("Ignoring checkpoint of a different patch: %s", checkpoint_fp)
+    return {}
+  return checkpoint["jobs"]
+
+
+def save_checkpoint(checkpoint_fp, fingerprint, jobs):
+  with open(checkpoint_fp + ".tmp", "w") as file:
+    json.dump({"fingerprint": fingerprint, "jobs": jobs}, file)
+  replace(checkpoint_fp + ".tmp", checkpoint_fp)
+
+
+def br_check_status(job_id="", environment_name="", token="", api_url=None, session=None):
+  if api_url is None:
+    api_url = api_url_from_environment(environment_name)
+  if session is None:
+    session = requests
+
+  url = f"{api_url}/jobs/{job_id}"
   headers = {
     "Authorization": "Bearer " + token
   }
   logger.info("Checking status for job: %s", url)
-  response = requests.get(url, headers=headers)
+  response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
   response.raise_for_status()
   state = response.json()["status"]
   logger.info("Current job status: %s", state)
@@ -69,7 +307,7 @@ def br_check_status(job_id="", environment_name="", token=""):
 
   if state in ["failed", "killed"]:
     logger.error("Job did not complete successfully: %s, %s", job_id, state)
-    raise ValueError("Full feed job did not complete successfully")
+    raise FeedJobError("Feed job %s did not complete successfully: %s" % (job_id, state))
   
   # TODO: check for the pending and queued states and return false on those
   return False
@@ -89,7 +327,7 @@ if __name__ == '__main__':
   )
   
   parser = argparse.ArgumentParser(
-    description="Makes a full feed API call using the patch jsonl as a request body using gzip compression."
+    description="Makes a full feed API call using the patch jsonl as a request body, using gzip compression when the patch file is gzip compressed."
   )
 
   parser.add_argument(
@@ -133,15 +371,64 @@ if __name__ == '__main__':
     required=not getenv("BR_API_TOKEN")
   )
 
+  parser.add_argument(
+    "--delta",
+    help="Send the patch as a delta feed with HTTP PATCH instead of a full feed with HTTP PUT",
+    action="store_true",
+    default=bool(getenv("BR_DELTA"))
+  )
+
+  parser.add_argument(
+    "--chunk-size-mb",
+    help="Split a delta feed patch into parts of about this many megabytes uncompressed, sent concurrently and resumable on rerun. By default the patch is sent in a single request.",
+    type=float,
+    default=float(getenv("BR_CHUNK_SIZE_MB", "0")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--concurrency",
+    help="Number of patch parts to upload concurrently",
+    type=int,
+    default=int(getenv("BR_UPLOAD_CONCURRENCY", "4")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--state-dir",
+    help="Directory to keep the checkpoint of a delta feed sent in parts in. Defaults to the directory of the input file.",
+    type=str,
+    default=getenv("BR_STATE_DIR"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--br-api-url",
+    help="Base URL of the feed API, e.g. http://localhost:8080/dataconnect/api/v1 for a local stand-in. Defaults to the Bloomreach API of the environment.",
+    type=str,
+    default=getenv("BR_API_URL"),
+    required=False
+  )
+
   args = parser.parse_args()
   fp_in = args.input_file
   environment_name = args.br_environment
   account_id = args.br_account_id
   catalog_name = args.br_catalog_name
   api_token = args.br_api_token
+  delta = args.delta
+  chunk_bytes = int(args.chunk_size_mb * 1024 * 1024)
+  concurrency = args.concurrency
+  api_url = args.br_api_url
+  checkpoint_dir = args.state_dir
 
   patch_catalog(fp_in, 
        environment_name=environment_name,
        account_id=account_id,
        catalog_name=catalog_name,
-       token=api_token)
+       token=api_token,
+       delta=delta,
+       chunk_bytes=chunk_bytes,
+       concurrency=concurrency,
+       api_url=api_url,
+       checkpoint_dir=checkpoint_dir)
@@ -0,0 +1,212 @@
+import logging
+import random
+from os import getenv
+from codec import dumps_line
+from compression import open_output
+
+logger = logging.getLogger(__name__)
+
+# (type, value factory) of the metafield types generated, list types are picked by list_share
+SCALAR_METAFIELD_TYPES = [
+  ("single_line_text_field", lambda rng, n: "value %s" % n),
+  ("multi_line_text_field", lambda rng, n: "line one %s\nline two" % n),
+  ("number_integer", lambda rng, n: str(rng.randint(0, 1000))),
+  ("number_decimal", lambda rng, n: "%.2f" % rng.uniform(0, 100)),
+  ("boolean", lambda rng, n: rng.choice(["true", "false"])),
+  ("date", lambda rng, n: "2024-%02d-%02d" % (rng.randint(1, 12), rng.randint(1, 28))),
+  ("json", lambda rng, n: dumps_line({"n": n, "tags": ["a", "b"]}).decode().rstrip("\n")),
+]
+
+LIST_METAFIELD_TYPES = [
+  ("list.single_line_text_field", lambda rng, n: dumps_line(["value %s" % i for i in range(rng.randint(1, 5))]).decode().rstrip("\n")),
+  ("list.number_integer", lambda rng, n: dumps_line([rng.randint(0, 1000) for _ in range(rng.randint(1, 5))]).decode().rstrip("\n")),
+]
+
+OPTION_VALUES = {
+  "Color": ["Black", "White", "Red", "Blue", "Green", "Grey"],
+  "Size": ["XS", "S", "M", "L", "XL", "XXL"],
+}
+
+
+def create_metafields(rng, parent_id, count, list_share, next_id):
+  metafields = []
+  for i in range(count):
+    types = LIST_METAFIELD_TYPES if rng.random() < list_share else SCALAR_METAFIELD_TYPES
+    metafield_type, create_value = rng.choice(types)
+    metafield_id = next_id()
+    metafields.append({
+      "id": "gid://shopify/Metafield/%s" % metafield_id,
+      "key": "key_%s" % i,
+      "value": create_value(rng, metafield_id),
+      "namespace": "custom",
+      "type": metafield_type,
+      "updatedAt": "2024-01-01T00:00:00Z",
+      "__parentId": parent_id
+    })
+  return metafields
+
+
+def create_product_objects(rng, n, variants, metafields, collections, collection_pool, list_share, next_id):
+  """
+  Returns the bulk output objects of a single product in the order the bulk API lists them:
+  the product, then its collections, metafields and variants, each variant followed by its metafields.
+  """
+  product_id = "gid://shopify/Product/%s" % n
+  min_price = round(rng.uniform(5, 200), 2)
+  objects = [{
+    "id": product_id,
+    "handle": "product-%s" % n,
+    "title": "Product %s" % n,
+    "createdAt": "2024-01-01T00:00:00Z",
+    "descriptionHtml": "<p>Description of product %s.</p>" % n,
+    "totalInventory": rng.randint(0, 500),
+    "onlineStorePreviewUrl": "https://example.myshopify.com/products/product-%s" % n,
+    "priceRangeV2": {
+      "maxVariantPrice": {"amount": "%.2f" % (min_price * 1.5)},
+      "minVariantPrice": {"amount": "%.2f" % min_price}
+    },
+    "featuredImage": {"url": "https://cdn.shopify.com/s/files/product-%s.jpg" % n} if rng.random() < 0.9 else None,
+    "productType": rng.choice(["Shirts", "Pants", "Shoes", "Accessories"]),
+    "seo": {"description": None, "title": None},
+    "status": "ACTIVE" if rng.random() < 0.9 else "DRAFT",
+    "storefrontId": "Z2lkOi8vc2hvcGlmeS9Qcm9kdWN0LzE%s" % n,
+    "tags": rng.sample(["new", "sale", "summer", "winter", "basics", "limited"], 2),
+    "vendor": rng.choice(["Acme", "Globex", "Initech"])
+  }]
+
+  for collection_id in rng.sample(collection_pool, min(collections, len(collection_pool))):
+    objects.append({
+      "id": "gid://shopify/Collection/%s" % collection_id,
+      "handle": "collection-%s" % collection_id,
+      "title": "Collection %s" % collection_id,
+      "__parentId": product_id
+    })
+
+  objects.extend(create_metafields(rng, product_id, metafields, list_share, next_id))
+
+  for v in range(variants):
+    variant_id = "gid://shopify/ProductVariant/%s" % next_id()
+    color = OPTION_VALUES["Color"][v % len(OPTION_VALUES["Color"])]
+    size = OPTION_VALUES["Size"][v // len(OPTION_VALUES["Color"]) % len(OPTION_VALUES["Size"])]
+    objects.append({
+      "id": variant_id,
+      "title": "%s / %s" % (color, size),
+      "sku": "SKU-%s-%s" % (n, v),
+      "price": "%.2f" % min_price,
+      "image": {"url": "https://cdn.shopify.com/s/files/variant-%s-%s.jpg" % (n, v)} if rng.random() < 0.5 else None,
+      "selectedOptions": [{"name": "Color", "value": color}, {"name": "Size", "value": size}],
+      "compareAtPrice": "%.2f" % (min_price * 1.2) if rng.random() < 0.3 else None,
+      "inventoryQuantity": rng.randint(0, 100),
+      "availableForSale": rng.random() < 0.8,
+      "__parentId": product_id
+    })
+    objects.extend(create_metafields(rng, variant_id, metafields, list_share, next_id))
+
+  return objects
+
+
+def main(fp_out, products=1000, variants=3, metafields=2, collections=2, list_share=0.25, collection_count=100, seed=1, compression=None):
+  """
+  Writes a synthetic Shopify bulk operation output with the same __parentId layout as the bulk API,
+  seeded so the same parameters always produce the same file.
+  """
+  rng = random.Random(seed)
+  collection_pool = list(range(1, collection_count + 1))
+  ids = iter(range(1, 2**62))
+
+  objects = 0
+  with open_output(fp_out, compression) as out:
+    for n in range(1, products + 1):
+      for shopify_object in create_product_objects(rng, n, variants, metafields, collections, collection_pool, list_share, ids.__next__):
+        out.write(dumps_line(shopify_object))
+        objects += 1
+
+  logger.info("Wrote %s products with %s bulk output objects to: %s", products, objects, fp_out)
+  return objects
+
+
+if __name__ == '__main__':
+  import argparse
+
+  from sys import stdout
+
+  # Define logger
+  loglevel = getenv('LOGLEVEL', 'INFO').upper()
+  logging.basicConfig(
+    stream=stdout,
+    level=loglevel,
+    format="%(name)-12s %(asctime)s %(levelname)-8s %(filename)s:%(funcName)s %(message)s"
+  )
+
+  parser = argparse.ArgumentParser(
+    description="Generates a synthetic Shopify bulk operation jsonl file of products, collections, variants and metafields in the layout of the bulk API, for benchmarking the transforms without a live store."
+  )
+
+  parser.add_argument(
+    "--output-file",
+    help="Filename of the generated bulk operation jsonl file",
+    type=str,
+    default=getenv("BR_OUTPUT_FILE", "0_shopify_bulk_op.jsonl.gz"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--products",
+    help="Number of products",
+    type=int,
+    default=1000
+  )
+
+  parser.add_argument(
+    "--variants",
+    help="Number of variants per product",
+    type=int,
+    default=3
+  )
+
+  parser.add_argument(
+    "--metafields",
+    help="Number of metafields per product and per variant",
+    type=int,
+    default=2
+  )
+
+  parser.add_argument(
+    "--collections",
+    help="Number of collections per product",
+    type=int,
+    default=2
+  )
+
+  parser.add_argument(
+    "--list-share",
+    help="Share of metafields with a list type, between 0 and 1",
+    type=float,
+    default=0.25
+  )
+
+  parser.add_argument(
+    "--seed",
+    help="Random seed",
+    type=int,
+    default=1
+  )
+
+  parser.add_argument(
+    "--compression",
+    help="Compression of the output file: gzip[:level], zstd[:level] or none. Defaults to gzip:6.",
+    type=str,
+    default=getenv("BR_COMPRESSION"),
+    required=False
+  )
+
+  args = parser.parse_args()
+
+  main(args.output_file,
+       products=args.products,
+       variants=args.variants,
+       metafields=args.metafields,
+       collections=args.collections,
+       list_share=args.list_share,
+       seed=args.seed,
+       compression=args.compression)
@@ -1,28 +1,139 @@
-import gzip
+import hashlib
+import io
 import json
 import logging
-import polling
+import queue
+import re
 import requests
 import shopify
 import shutil
-from os import getenv
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from contextvars import copy_context
+from datetime import datetime, timezone
+from functools import lru_cache
+from os import getenv, path, remove
 from pathlib import Path
+from time import monotonic
+from compression import open_input, open_output
+from poller import poll
+from projection import load_projection
+from shopify_products import OutOfOrderError
 
 logger = logging.getLogger(__name__)
 
+# streamed downloads are handed from the reader thread to the consumer in batches of lines
+DOWNLOAD_BATCH_SIZE = 1000
+DOWNLOAD_QUEUE_SIZE = 16
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
 
-def export_jsonl(context):
+QUERIES_DIR = Path(__file__).parent / "graphql_queries"
+
+# the bulk query inside a bulkOperationRunQuery mutation
+BULK_QUERY = re.compile(r'query:\s*"""(.*?)"""', re.S)
+
+
+class BulkOperationError(RuntimeError):
+  """
+  Raised when a bulk operation doesn't complete successfully, with the url of the data it
+  exported before it stopped, when Shopify kept any.
+  """
+  def __init__(self, message, job_id, status, partial_data_url=None):
+    super().__init__(message)
+    self.job_id = job_id
+    self.status = status
+    self.partial_data_url = partial_data_url
+
+
+# query files are read once per process instead of on every poll
+@lru_cache(maxsize=None)
+def load_query(name):
+  return (QUERIES_DIR / name).read_text()
+
+
+def build_export_query(updated_since=None, id_range=None, projection_fp=None):
+  """
+  Returns the ExportDataJob query, selecting the fields of the projection config at projection_fp (see
+  projection.build_bulk_query), limited to products updated after updated_since (an ISO 8601 timestamp) when it is given.
+
+  id_range limits it to a (low, high) range of numeric product ids, low inclusive and high exclusive,
+  where either end may be None to leave it open.
+  """
+  bulk_query = load_projection(projection_fp).replace("\n", "\n            ")
+  query = BULK_QUERY.sub(lambda match: 'query: """\n            %s\n            """' % bulk_query, load_query("export_data_job.graphql"), 1)
+  terms = []
+  if updated_since:
+    terms.append("updated_at:>'%s'" % updated_since)
+  if id_range:
+    low, high = id_range
+    if low is not None:
+      terms.append("id:>=%s" % low)
+    if high is not None:
+      terms.append("id:<%s" % high)
+
+  if terms:
+    query = query.replace("products {", "products(query:\"%s\") {" % " AND ".join(terms), 1)
+  return query
+
+
+def create_client(shop_url, api_version, token, api_url=None):
+  """
+  Activates a Shopify session and returns a GraphQL client for it.
+
+  api_url is the base URL of the Admin API, e.g. http://localhost:8081/admin/api/2025-04 for a local stand-in.
+  It defaults to the shop's Admin API.
+  """
+  session = shopify.Session(shop_url, api_version, token)
+  shopify.ShopifyResource.activate_session(session)
+  client = shopify.GraphQL()
+  if api_url:
+    client.endpoint = api_url + "/graphql.json"
+  return client
+
+
+def query_fingerprint(query):
+  """
+  Returns a fingerprint of a bulk query, or of the bulk query inside a bulkOperationRunQuery mutation,
+  that doesn't depend on its whitespace.
+  """
+  match = BULK_QUERY.search(query)
+  if match:
+    query = match.group(1)
+  return hashlib.sha1("".join(query.split()).encode()).hexdigest()
+
+
+def get_current_job(client):
+  """
+  Returns the shop's current bulk operation, the most recent one submitted by this app, or None.
+  """
+  result = client.execute(query=load_query("current_job.graphql"),
+                          operation_name="CurrentJob")
+  result_json = json.loads(result)
+
+  if 'errors' in result_json:
+    raise RuntimeError("Errors encountered while running CurrentJob query")
+
+  return result_json["data"]["currentBulkOperation"]
+
+
+def export_jsonl(context, client=None, query=None, operation_name="ExportDataJob"):
   """
   Attempts to run a Bulk Operation query to initiate a job
   that will extract a JSONL file with all of a Shop's product information.
 
+  If the shop's current Bulk Operation is still running the same query, e.g. the export of an overlapping run,
+  no job is submitted and True is returned after attaching to it: its job id is added to context and
+  context["attached"] is set. Only the most recent operation of the app is checked, see get_current_job.
+
   If the job is successfully submitted, returns True and adds job id to context.
 
-  If the job can't be submitted because there is another Bulk Operation running,
-  returns False.
+  If the job can't be submitted because there is another Bulk Operation running, returns False.
 
   If the job can't be submitted for an unknown reason, a RuntimeError is raised.
 
+  A different bulk query, such as one built by build_export_query, may be passed along with its operation name.
+
   The job is async and this response will return a job id, 
   so status needs to be polled via another query.
 
@@ -40,14 +151,26 @@ def export_jsonl(context):
           * metafields
           * selected options
   """
-  query = Path('./src/graphql_queries/export_data_job.graphql').read_text()
-  logger.info("ExportDataJob attempt")
-  result = shopify.GraphQL().execute(query=query,
-                                     operation_name="ExportDataJob")
+  if client is None:
+    client = shopify.GraphQL()
+
+  if query is None:
+    query = build_export_query()
+
+  current = get_current_job(client)
+  if current and current["status"] in ["CREATED", "RUNNING"] and query_fingerprint(current.get("query") or "") == query_fingerprint(query):
+    logger.info("GraphQL Bulk Operation not submitted, attaching to the same %s already in progress. Job id: %s", operation_name, current["id"])
+    context["job_id"] = current["id"]
+    context["attached"] = True
+    return True
+
+  logger.info("%s attempt", operation_name)
+  result = client.execute(query=query,
+                          operation_name=operation_name)
   result_json = json.loads(result)
 
   if 'errors' in result_json:
-    raise RuntimeError("Errors encountered while running ExportDataJob query")
+    raise RuntimeError("Errors encountered while running %s query" % operation_name)
 
   bulkOperation = result_json["data"]["bulkOperationRunQuery"]["bulkOperation"]
 
@@ -58,14 +181,15 @@ def export_jsonl(context):
     context["job_id"] = job_id
     return True
   elif "already in progress" in result:
+    # the operation in progress is checked again before the next attempt
     logger.info("GraphQL Bulk Operation not submitted, trying again after delay. Another operation already in progress: %s", result_json)
     return False
   else:
     logger.error(result_json)
-    raise RuntimeError("Unable to start ExportDataJob")
+    raise RuntimeError("Unable to start %s" % operation_name)
 
 
-def get_jsonl_url(job_id, context):
+def get_jsonl_url(job_id, context, client=None):
   """
   Given a Bulk Operation job id, polls for status and objectCount.
 
@@ -74,16 +198,21 @@ def get_jsonl_url(job_id, context):
   If job is still in progress, returns False.
 
   If job is completed successfully, returns True with jsonl url added to context.
+
+  The current objectCount is added to context on every call.
   
   If job does not complete successfully, raises a RuntimeError.
 
   https://shopify.dev/api/usage/bulk-operations/queries#option-b-poll-a-running-bulk-operation
   """
-  query = Path('./src/graphql_queries/get_job.graphql').read_text()
+  if client is None:
+    client = shopify.GraphQL()
+
+  query = load_query("get_job.graphql")
   logger.info("GetJob query for job_id: %s" % job_id)
-  result = shopify.GraphQL().execute(query=query,
-                                     operation_name="GetJob",
-                                     variables={"job_id": job_id})
+  result = client.execute(query=query,
+                          operation_name="GetJob",
+                          variables={"job_id": job_id})
   result_json = json.loads(result)
 
   if 'errors' in result_json:
@@ -91,6 +220,7 @@ def get_jsonl_url(job_id, context):
 
   node = result_json["data"]["node"]
   state = node["status"]
+  context["objectCount"] = int(node["objectCount"])
   logger.info("GraphQL Bulk Operation current state: %s", state)
 
   # https://shopify.dev/api/admin-graphql/2023-01/enums/bulkoperationstatus
@@ -98,46 +228,454 @@ def get_jsonl_url(job_id, context):
     logger.info("GraphQL Bulk Operation completed successfully, jsonl at url: %s", node["url"])
     logger.info("GraphQL Bulk Operation objectCount: %s", node["objectCount"])
     context["url"] = node["url"]
+
+    # time between the job completing and this poll noticing it
+    completed_at = datetime.fromisoformat(node["completedAt"].replace("Z", "+00:00"))
+    context["completionLatency"] = (datetime.now(timezone.utc) - completed_at).total_seconds()
+    logger.info("GraphQL Bulk Operation poll to completion latency: %.1fs", context["completionLatency"])
     return True
 
   if state in ["CANCELED", "CANCELING", "EXPIRED", "FAILED"]:
-    logger.error("GraphQL Bulk Operation did not complete successfully: %s, %s", job_id, state)
-    raise RuntimeError("Full feed job did not complete successfully")
+    logger.error("GraphQL Bulk Operation did not complete successfully: %s, %s, %s", job_id, state, node.get("errorCode"))
+    raise BulkOperationError("Full feed job did not complete successfully", job_id, state, node.get("partialDataUrl"))
 
   logger.info("GraphQL Bulk Operation current objectCount: %s", node["objectCount"])
 
   return False
 
 
-def download_file(url, local_filename):
+# export parts are urls, or the file paths of salvaged partial data
+def is_url(part):
+  return part.startswith(("http://", "https://"))
+
+
+def download_file(url, local_filename, compression=None):
+  # a bulk operation that matched no objects has no output url
+  if url is None:
+    with open_output(local_filename, compression):
+      return local_filename
+
   with requests.get(url, stream=True) as r:
-    with gzip.open(local_filename, 'wb') as f:
+    with open_output(local_filename, compression) as f:
       shutil.copyfileobj(r.raw, f)
   return local_filename
 
 
-def get_shopify_jsonl_fp(shop_url, api_version, token, output_dir, run_num=""):
-  session = shopify.Session(shop_url, api_version, token)
-  shopify.ShopifyResource.activate_session(session)
+@contextmanager
+def open_part(part):
+  if not is_url(part):
+    with open_input(part) as file:
+      yield file
+    return
+
+  with requests.get(part, stream=True) as r:
+    r.raise_for_status()
+    r.raw.decode_content = True
+    # keep the raw response open at EOF so it can be read through io.BufferedReader
+    r.raw.auto_close = False
+    yield io.BufferedReader(r.raw, buffer_size=DOWNLOAD_BUFFER_SIZE)
+
+
+def iter_download_lines(url, tee_fp=None, compression=None, batch_size=DOWNLOAD_BATCH_SIZE):
+  """
+  Streams the lines of a bulk operation output straight from its URL,
+  so download, decompression and parsing overlap instead of running one after another.
+
+  The response is read, decoded and optionally teed to tee_fp in a background thread,
+  which hands batches of lines to the consumer through a bounded queue.
+
+  url may also be a list of the parts of a sharded or resumed export, urls or files of salvaged partial data,
+  whose lines are streamed one after another.
+  """
+  # a bulk operation that matched no objects has no output url
+  urls = [u for u in (url if isinstance(url, list) else [url]) if u is not None]
+  if not urls:
+    if tee_fp:
+      with open_output(tee_fp, compression):
+        pass
+    return
+
+  batches = queue.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+  stop = threading.Event()
+
+  def put(item):
+    # give up if the consumer stopped reading, otherwise the thread would block forever
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=1)
+        return True
+      except queue.Full:
+        continue
+    return False
 
+  def read():
+    try:
+      with (open_output(tee_fp, compression) if tee_fp else nullcontext()) as tee:
+        batch = []
+        for u in urls:
+          with open_part(u) as lines:
+            for line in lines:
+              if tee:
+                tee.write(line)
+              batch.append(line)
+              if len(batch) >= batch_size:
+                if not put(batch):
+                  return
+                batch = []
+        if batch:
+          put(batch)
+      put(None)
+    except Exception as e:
+      put(e)
+
+  if tee_fp:
+    logger.info("Saving jsonl file to: %s", tee_fp)
+  reader = threading.Thread(target=copy_context().run, args=(read,), daemon=True)
+  reader.start()
+
+  try:
+    while True:
+      batch = batches.get()
+      if batch is None:
+        break
+      if isinstance(batch, Exception):
+        raise batch
+      yield from batch
+  finally:
+    stop.set()
+    reader.join()
+
+
+def run_bulk_operation(client, query=None, operation_name="ExportDataJob", expected_object_count=None, stats=None, name="GraphQL Bulk Operation", cancel=None):
+  """
+  Submits a bulk operation and polls it until the jsonl url is available, returning the url and the job id.
+
+  When a stats dict is passed, it is updated with the objectCount, the number of polls,
+  the seconds spent polling and the poll to completion latency of the job, as well as
+  the number of submission attempts and seconds spent submitting it, and whether it attached
+  to the same operation already in progress instead of submitting its own.
+
+  cancel is an optional threading.Event that stops the polls, see poller.poll.
+  """
   # Submit a job to export jsonl data.
   context = {}
-  polling.poll(lambda: export_jsonl(context), step=20, timeout=7200)
+  submit_stats = poll(lambda: export_jsonl(context, client, query, operation_name), step=5, max_step=60, timeout=7200, name="%s submission" % name, cancel=cancel)
 
   job_id = context["job_id"]
+  attached = context.get("attached", False)
 
   # Get jsonl url path
   context = {}
-  polling.poll(lambda: get_jsonl_url(job_id, context), step=20, timeout=7200)
+  poll_stats = poll(lambda: get_jsonl_url(job_id, context, client),
+                    progress=lambda: context.get("objectCount"),
+                    expected_total=expected_object_count,
+                    step=1, max_step=60, timeout=7200, name=name, cancel=cancel)
+
+  if stats is not None:
+    stats.update(poll_stats)
+    stats["objectCount"] = context["objectCount"]
+    stats["completionLatency"] = context["completionLatency"]
+    stats["submitPolls"] = submit_stats["polls"]
+    stats["submitSeconds"] = submit_stats["seconds"]
+    stats["attached"] = attached
+
+  return context["url"], job_id
+
+
+def get_shopify_jsonl_url(shop_url, api_version, token, expected_object_count=None, stats=None, query=None, operation_name="ExportDataJob", api_url=None):
+  """
+  Submits the export job and polls it until the jsonl url is available.
+
+  Polling starts fast and backs off adaptively. When expected_object_count is known, e.g. the objectCount
+  of the previous run, polls are timed from the estimated completion time of the job.
+
+  query and operation_name select a bulk query other than the full ExportDataJob.
+
+  When a stats dict is passed, it is updated as described in run_bulk_operation.
+  """
+  client = create_client(shop_url, api_version, token, api_url)
+  jsonl_url, job_id = run_bulk_operation(client, query, operation_name, expected_object_count, stats)
+  shopify.ShopifyResource.clear_session()
 
-  jsonl_url = context["url"]
-  job_id_short = job_id.split('/')[-1]
+  return jsonl_url, job_id.split('/')[-1]
+
+
+def get_shopify_jsonl_fp(shop_url, api_version, token, output_dir, run_num="", compression=None, expected_object_count=None, stats=None, query=None, operation_name="ExportDataJob", filename="0_shopify_bulk_op.jsonl.gz", api_url=None):
+  jsonl_url, job_id_short = get_shopify_jsonl_url(shop_url, api_version, token, expected_object_count, stats, query, operation_name, api_url)
   
-  jsonl_fp = output_dir + "/0_shopify_bulk_op.jsonl.gz"
+  jsonl_fp = output_dir + "/" + filename
   logger.info("Saving jsonl file to: %s", jsonl_fp)
-  download_file(jsonl_url, jsonl_fp)
+  start = monotonic()
+  download_file(jsonl_url, jsonl_fp, compression)
 
-  shopify.ShopifyResource.clear_session()
+  if stats is not None:
+    stats["downloadSeconds"] = monotonic() - start
+    stats["downloadBytes"] = path.getsize(jsonl_fp)
+
+  return jsonl_fp, job_id_short
+
+
+def get_product_id_bounds(client):
+  """
+  Returns the lowest and highest numeric product ids of the shop, or None when it has no products.
+  """
+  result = client.execute(query=load_query("product_id_bounds.graphql"),
+                          operation_name="ProductIdBounds")
+  result_json = json.loads(result)
+
+  if 'errors' in result_json:
+    raise RuntimeError("Errors encountered while running ProductIdBounds query")
+
+  first = result_json["data"]["first"]["edges"]
+  last = result_json["data"]["last"]["edges"]
+  if not first:
+    return None
+  return int(first[0]["node"]["id"].split('/')[-1]), int(last[0]["node"]["id"].split('/')[-1])
+
+
+def split_id_range(bounds, shards):
+  """
+  Splits the (lowest, highest) product ids into up to shards (low, high) ranges of equal width,
+  low inclusive and high exclusive.
+
+  The first and last ranges are left open, so products created after the bounds were read are still exported.
+  """
+  if bounds is None or shards < 2:
+    return [(None, None)]
+
+  lowest, highest = bounds
+  width = max((highest - lowest + 1) // shards, 1)
+  edges = sorted({lowest + width * i for i in range(1, shards) if lowest + width * i <= highest})
+  edges = [None] + edges + [None]
+  return list(zip(edges, edges[1:]))
+
+
+def salvage_partial_data(partial_data_url, fp, compression=None):
+  """
+  Downloads the partial output of a failed bulk operation to fp, keeping only its complete products.
+
+  Objects are listed after their product, so the last product may be missing children, and the last
+  line may be cut short. The last product is dropped along with its children.
+
+  Returns the numeric id of the dropped product, which the export resumes from, and the number of
+  objects kept. The id is None when not a single product was started.
+
+  Resuming from the dropped product only exports every missing product when products are listed in id order.
+  Raises an OutOfOrderError when the product ids of the partial data aren't strictly increasing.
+  """
+  kept = 0
+  product = []
+  last_id = None
+  with open_part(partial_data_url) as lines, open_output(fp, compression) as file:
+    for line in lines:
+      if not line.endswith(b"\n"):
+        break
+      # a line without a parent starts the next product, so the one before it is complete
+      if b'"__parentId"' not in line:
+        product_id = int(json.loads(line)["id"].split('/')[-1])
+        if last_id is not None and product_id <= last_id:
+          raise OutOfOrderError("Partial data lists product %s after product %s, not in product id order" % (product_id, last_id))
+        last_id = product_id
+        file.write(b"".join(product))
+        kept += len(product)
+        product = []
+      product.append(line)
+
+  if not product:
+    return None, kept
+  return last_id, kept
+
+
+def run_export(client, output_dir, updated_since=None, id_range=None, expected_object_count=None, stats=None,
+               name="GraphQL Bulk Operation", resume_attempts=0, compression=None, part_prefix="0_shopify_bulk_op", projection_fp=None,
+               cancel=None):
+  """
+  Runs the products export over a range of product ids, resuming it when it fails.
+
+  When an operation fails with partial data, its complete products are salvaged to a file in output_dir
+  and a follow up operation exports the rest of the range, from the first product that wasn't complete.
+  This relies on products being exported in id order. Partial data that isn't in id order is discarded
+  and the follow up exports the whole remaining range again, so products below the cursor can't be lost.
+  After resume_attempts follow ups, the failure is raised.
+
+  Returns the parts of the output in order, the file paths of salvaged data and the url of the operation
+  that completed, along with the job id of the first operation. When a stats dict is passed, it is updated
+  with the stats of run_bulk_operation summed over the operations, and the number of resumes.
+  """
+  low, high = id_range or (None, None)
+  parts = []
+  job_ids = []
+  attempt_stats = []
+
+  for attempt in range(resume_attempts + 1):
+    attempt_stats.append({})
+    query = build_export_query(updated_since, (low, high), projection_fp)
+    start = monotonic()
+    try:
+      jsonl_url, job_id = run_bulk_operation(client, query,
+                                             expected_object_count=expected_object_count,
+                                             stats=attempt_stats[-1],
+                                             name=name,
+                                             cancel=cancel)
+      parts.append(jsonl_url)
+      job_ids.append(job_id)
+      break
+    except BulkOperationError as e:
+      if attempt == resume_attempts or e.partial_data_url is None:
+        raise
+      job_ids.append(e.job_id)
+      # the polls of a failed operation aren't known, only the time it took
+      attempt_stats[-1]["seconds"] = monotonic() - start
+
+      part_fp = "%s/%s.partial%s.jsonl.gz" % (output_dir, part_prefix, attempt)
+      try:
+        resume_id, kept = salvage_partial_data(e.partial_data_url, part_fp, compression)
+      except OutOfOrderError as order_error:
+        remove(part_fp)
+        logger.warning("%s %s, discarding its partial data and exporting the range again: %s", name, e.status, order_error)
+        continue
+      parts.append(part_fp)
+      attempt_stats[-1]["objectCount"] = kept
+      if resume_id is not None:
+        low = resume_id
+      logger.warning("%s %s, salvaged %s objects to %s, resuming from product id %s", name, e.status, kept, part_fp, low)
+
+  if stats is not None:
+    for key in ["objectCount", "polls", "seconds", "submitPolls", "submitSeconds"]:
+      stats[key] = sum(s.get(key, 0) for s in attempt_stats)
+    stats["completionLatency"] = attempt_stats[-1]["completionLatency"]
+    stats["resumes"] = len(attempt_stats) - 1
+    stats["attached"] = any(s.get("attached") for s in attempt_stats)
+
+  return parts, job_ids[0]
+
+
+def merge_export_stats(stats, shard_stats):
+  # shards run side by side, so the wall time of a phase is that of its slowest shard
+  stats["shards"] = len(shard_stats)
+  stats["objectCount"] = sum(s["objectCount"] for s in shard_stats)
+  stats["polls"] = sum(s["polls"] for s in shard_stats)
+  stats["seconds"] = max(s["seconds"] for s in shard_stats)
+  stats["completionLatency"] = max(s["completionLatency"] for s in shard_stats)
+  stats["submitPolls"] = sum(s["submitPolls"] for s in shard_stats)
+  stats["submitSeconds"] = max(s["submitSeconds"] for s in shard_stats)
+  stats["resumes"] = sum(s["resumes"] for s in shard_stats)
+  stats["attached"] = any(s["attached"] for s in shard_stats)
+
+
+def get_products_jsonl_parts(shop_url, api_version, token, output_dir, shards=1, updated_since=None, expected_object_count=None, stats=None,
+                             api_url=None, resume_attempts=0, compression=None, on_complete=None, projection_fp=None):
+  """
+  Runs the products export as concurrent bulk operations, one per range of product ids, and polls them until
+  they complete, resuming failed operations up to resume_attempts times as described in run_export.
+
+  The shop's product ids are split into shards ranges of equal width, so shards are as even as product
+  creation has been over time. Running bulk query operations side by side needs an Admin API version
+  that allows it (2026-01 or later), otherwise each submission waits for the previous operation to finish.
+
+  on_complete is an optional function called with the shard number and output parts of each shard as soon as
+  it completes, e.g. to download it while the other shards are still running.
+
+  The first shard to fail stops the polls of the others, and its error is raised without waiting for them.
+  Their bulk operations are left to finish on Shopify. A rerun attaches to the one submitted last when it is
+  still running, as only the most recent operation can be looked up, see export_jsonl.
+
+  Returns the output parts of all shards in product id order and the short job id of the first shard.
+  When a stats dict is passed, it is updated with the stats of run_export merged over the shards.
+  """
+  client = create_client(shop_url, api_version, token, api_url)
+  id_ranges = split_id_range(get_product_id_bounds(client) if shards > 1 else None, shards)
+  logger.info("Exporting products in %s shards of product ids: %s", len(id_ranges), id_ranges)
+
+  # clients read the session when they are created, so they are created before it is cleared
+  clients = [client] + [create_client(shop_url, api_version, token, api_url) for _ in id_ranges[1:]]
+  shard_stats = [{} for _ in id_ranges]
+  shard_expected = expected_object_count // len(id_ranges) if expected_object_count else None
+
+  def run(shard):
+    parts, job_id = run_export(clients[shard], output_dir, updated_since, id_ranges[shard],
+                               expected_object_count=shard_expected,
+                               stats=shard_stats[shard],
+                               name="GraphQL Bulk Operation shard %s" % shard,
+                               resume_attempts=resume_attempts,
+                               compression=compression,
+                               part_prefix="0_shopify_bulk_op.shard%s" % shard,
+                               projection_fp=projection_fp,
+                               cancel=cancel)
+    if on_complete and not cancel.is_set():
+      on_complete(shard, parts)
+    return parts, job_id
+
+  cancel = threading.Event()
+  results = [None] * len(id_ranges)
+  try:
+    with ThreadPoolExecutor(max_workers=len(id_ranges)) as executor:
+      # shards run in the context of the caller, such as the store of an orchestrated run
+      futures = {executor.submit(copy_context().run, run, shard): shard for shard in range(len(id_ranges))}
+      try:
+        for future in as_completed(futures):
+          results[futures[future]] = future.result()
+      except BaseException:
+        cancel.set()
+        raise
+  finally:
+    shopify.ShopifyResource.clear_session()
+
+  if stats is not None:
+    merge_export_stats(stats, shard_stats)
+
+  return [part for parts, _ in results for part in parts], results[0][1].split('/')[-1]
+
+
+def get_products_jsonl_fp(shop_url, api_version, token, output_dir, shards=1, updated_since=None, compression=None, expected_object_count=None, stats=None,
+                          filename="0_shopify_bulk_op.jsonl.gz", api_url=None, resume_attempts=0, projection_fp=None):
+  """
+  Runs the products export with get_products_jsonl_parts, downloading each shard as soon as it completes,
+  and merges the shard files and any salvaged partial data into one file.
+
+  Parts hold disjoint products, each followed by its children, so the merged file is their concatenation.
+  Compressed parts concatenate into a valid multi-member gzip or multi-frame zstd file.
+  Downloaded parts are removed once merged, while files of salvaged partial data are kept.
+  """
+  jsonl_fp = output_dir + "/" + filename
+  shard_fps = {}
+  download_seconds = [0]
+
+  def download(shard, parts):
+    start = monotonic()
+    fps = []
+    for part in parts:
+      downloaded = part is None or is_url(part)
+      if downloaded:
+        part = download_file(part, "%s.shard%s.part%s" % (jsonl_fp, shard, len(fps)), compression)
+      fps.append((part, downloaded))
+    shard_fps[shard] = fps
+    download_seconds.append(monotonic() - start)
+
+  _, job_id_short = get_products_jsonl_parts(shop_url, api_version, token, output_dir, shards,
+                                             updated_since=updated_since,
+                                             expected_object_count=expected_object_count,
+                                             stats=stats,
+                                             api_url=api_url,
+                                             resume_attempts=resume_attempts,
+                                             compression=compression,
+                                             on_complete=download,
+                                             projection_fp=projection_fp)
+
+  logger.info("Merging %s shards into jsonl file: %s", len(shard_fps), jsonl_fp)
+  start = monotonic()
+  with open(jsonl_fp, "wb") as file:
+    for shard in sorted(shard_fps):
+      for fp, downloaded in shard_fps[shard]:
+        with open(fp, "rb") as part_file:
+          shutil.copyfileobj(part_file, file)
+        if downloaded:
+          remove(fp)
+
+  if stats is not None:
+    # downloads overlap the slower shards, so only the slowest one and the merge add to the run time
+    stats["downloadSeconds"] = max(download_seconds) + monotonic() - start
+    stats["downloadBytes"] = path.getsize(jsonl_fp)
 
   return jsonl_fp, job_id_short
 
@@ -1,12 +1,632 @@
 import logging
-from datetime import datetime
-from os import getenv
-from bloomreach_generics import main as brGenerics
-from bloomreach_products import main as brProducts
-from feed import patch_catalog
-from shopify_products import main as shopifyProducts
-from patch import main as brPatch
-from graphql import get_shopify_jsonl_fp
+from datetime import datetime, timedelta
+from contextlib import ExitStack
+from functools import partial
+from time import perf_counter
+from os import getenv, path
+import bloomreach_generics
+import bloomreach_products
+import patch
+from delta import commit_index, create_delta, create_index
+from feed import FEED_CODECS, patch_catalog
+from metrics import add_timing, add_timings, file_size, record_stage, record_timing, set_stage, timed, write_json, write_textfile
+from codec import dumps_line, loads
+from compression import check_compression, open_output
+from parallel import map_batches
+import snapshot
+from fast_sync import FAST_SYNC_PROJECTION_FP, attribute_index_path, create_attribute_patch, load_product_paths, rebuild_attribute_index
+from shopify_products import consume_products, create_product_from_lines
+from graphql import build_export_query, get_products_jsonl_fp, get_products_jsonl_parts, get_shopify_jsonl_fp, get_shopify_jsonl_url, iter_download_lines, load_query
+
+logger = logging.getLogger(__name__)
+
+
+# fused pipeline: each aggregated shopify product flows through every transform
+# as a python dict and only the final patch op is serialized
+#   when a timings dict is passed, the time each transform takes per product is added to it by stage name
+#   caches are shared by the generic transform of the products, see bloomreach_generics.create_product
+def create_patch_ops(shopify_products, shopify_url, pid_props=None, vid_props=None, taps=None, timings=None, mapping_fp=None, caches=None):
+  if taps is None:
+    taps = {}
+  if caches is None:
+    caches = {}
+
+  for shopify_product in shopify_products:
+    write_tap(taps, "shopify_products", shopify_product)
+
+    start = perf_counter()
+    generic_product = bloomreach_generics.create_product(shopify_product, pid_props, vid_props, caches)
+    record_timing(timings, "generic_products", start)
+    write_tap(taps, "generic_products", generic_product)
+
+    start = perf_counter()
+    br_product = bloomreach_products.create_product(generic_product, shopify_url, mapping_fp)
+    record_timing(timings, "br_products", start)
+    write_tap(taps, "br_products", br_product)
+
+    start = perf_counter()
+    op = patch.create_add_product_op(br_product)
+    record_timing(timings, "patch", start)
+    yield op
+
+
+# taps map a stage name to a callable receiving that stage's output
+def write_tap(taps, name, object):
+  if name in taps:
+    taps[name](object)
+
+
+# worker for parallel mode, runs every transform of each catalog target for a batch of raw product lines
+#   or a batch of aggregated product lines when aggregated is True
+#   returns the serialized patch op of every target, the serialized output of each tapped stage and the seconds of each stage, per product
+def create_patch_lines(product_lines, targets, tap_names=(), aggregated=False):
+  results = []
+  caches = {}
+  for lines in product_lines:
+    result = {"patches": []}
+    taps = {name: partial(set_line, result, name) for name in tap_names}
+    timings = {}
+    start = perf_counter()
+    product = loads(lines) if aggregated else create_product_from_lines(lines)
+    record_timing(timings, "shopify_products", start)
+    for target in targets:
+      for op in create_patch_ops([product], target["shopify_url"], target["pid_props"], target["vid_props"], taps, timings, target["mapping_fp"], caches):
+        result["patches"].append(dumps_line(op))
+    result["timings"] = {name: timing["seconds"] for name, timing in timings.items()}
+    results.append(result)
+  return results
+
+
+def set_line(result, name, object):
+  result[name] = dumps_line(object)
+
+
+def write_line(file, object):
+  file.write(dumps_line(object))
+
+
+# writes the patch of each catalog target in a single pass over the bulk output file, or a callable streaming its lines,
+#   or over every product in the snapshot when db is passed
+#   targets are dicts with the shopify_url, pid_props, vid_props, mapping_fp and patch_fp of each catalog,
+#   so the export and aggregation are shared by every catalog
+# intermediate stage outputs are only written when tap file paths are supplied
+# per product stage timings are added to timings when it is passed
+#   executor is an optional process pool shared with other runs to transform products in, see orchestrator.py
+def run_pipeline(shopify_jsonl_fp, targets, workers=1, compression=None, tap_fps=None, tap_compression=None, timings=None, db=None, spill_dir=None, executor=None):
+  write = partial(write_pipeline, targets=targets, compression=compression, tap_fps=tap_fps, tap_compression=tap_compression, timings=timings)
+  write_parallel = partial(write_pipeline_parallel, targets=targets, workers=workers, compression=compression, tap_fps=tap_fps, tap_compression=tap_compression, timings=timings, executor=executor)
+
+  if db is not None:
+    count = write_parallel(snapshot.iter_product_lines(db), aggregated=True) if workers > 1 else write(snapshot.iter_products(db))
+  else:
+    # outputs are rewritten from scratch on the spilled index fallback as already written products may be incomplete
+    count = consume_products(shopify_jsonl_fp, write, consume_lines=write_parallel if workers > 1 else None, spill_dir=spill_dir, timings=timings)
+
+  if len(targets) == 1:
+    logger.info("Wrote %s patch operations to: %s", count, targets[0]["patch_fp"])
+  else:
+    logger.info("Wrote %s products to the patches of %s catalogs", count, len(targets))
+  return count
+
+
+# each aggregated product is transformed once per catalog target and written to the target's patch
+def write_pipeline(products, targets, compression=None, tap_fps=None, tap_compression=None, timings=None):
+  count = 0
+  caches = {}
+  with ExitStack() as stack:
+    taps = {name: partial(write_line, stack.enter_context(open_output(fp, tap_compression))) for name, fp in (tap_fps or {}).items()}
+    outs = [stack.enter_context(open_output(target["patch_fp"], compression)) for target in targets]
+
+    # the time to produce each aggregated product covers reading and aggregating its bulk output
+    for shopify_product in timed(products, timings, "shopify_products"):
+      for target, out in zip(targets, outs):
+        for op in create_patch_ops([shopify_product], target["shopify_url"], target["pid_props"], target["vid_props"], taps, timings, target["mapping_fp"], caches):
+          start = perf_counter()
+          out.write(dumps_line(op))
+          record_timing(timings, "write_patch", start)
+      count += 1
+
+  return count
+
+
+# same as write_pipeline, but batches of products are aggregated and transformed in worker processes
+#   product_lines are the raw bulk output lines of each product, or aggregated product lines when aggregated is True
+def write_pipeline_parallel(product_lines, targets, workers=1, compression=None, tap_fps=None, tap_compression=None, aggregated=False, timings=None, executor=None):
+  if tap_fps is None:
+    tap_fps = {}
+
+  # workers only need the transform settings of each target
+  transforms = [{k: target[k] for k in ["shopify_url", "pid_props", "vid_props", "mapping_fp"]} for target in targets]
+  func = partial(create_patch_lines, targets=transforms, tap_names=tuple(tap_fps), aggregated=aggregated)
+
+  count = 0
+  with ExitStack() as stack:
+    tap_files = {name: stack.enter_context(open_output(fp, tap_compression)) for name, fp in tap_fps.items()}
+    outs = [stack.enter_context(open_output(target["patch_fp"], compression)) for target in targets]
+
+    for result in map_batches(func, product_lines, workers, executor=executor):
+      for name, tap_file in tap_files.items():
+        tap_file.write(result[name])
+      start = perf_counter()
+      for out, line in zip(outs, result["patches"]):
+        out.write(line)
+      record_timing(timings, "write_patch", start)
+      if timings is not None:
+        for name, seconds in result["timings"].items():
+          add_timing(timings, name, seconds)
+      count += 1
+
+  return count
+
+
+# exports the bulk output, returning either its downloaded file path or a callable streaming its lines
+def export_shopify_jsonl(shopify_url, shopify_pat, api_version, output_dir, run_num,
+                         stream_download=False, save_bulk_file=True, compression=None,
+                         expected_object_count=None, stats=None, query=None,
+                         operation_name="ExportDataJob", filename="0_shopify_bulk_op.jsonl.gz",
+                         updated_since=None, shards=1, shopify_api_url=None, resume_attempts=0, projection_fp=None):
+  # the products export may be split into shards running side by side and resumed when it fails,
+  #   other queries run as a single bulk operation
+  if query is None and (shards > 1 or resume_attempts):
+    if stream_download:
+      jsonl_parts, job_id = get_products_jsonl_parts(shopify_url, api_version, shopify_pat, output_dir, shards,
+                                                     updated_since=updated_since,
+                                                     expected_object_count=expected_object_count,
+                                                     stats=stats,
+                                                     api_url=shopify_api_url,
+                                                     resume_attempts=resume_attempts,
+                                                     compression=compression,
+                                                     projection_fp=projection_fp)
+      tee_fp = output_dir + "/" + filename if save_bulk_file else None
+      return partial(iter_download_lines, jsonl_parts, tee_fp, compression), job_id
+
+    return get_products_jsonl_fp(shopify_url, api_version, shopify_pat, output_dir, shards,
+                                 updated_since=updated_since,
+                                 compression=compression,
+                                 expected_object_count=expected_object_count,
+                                 stats=stats,
+                                 filename=filename,
+                                 api_url=shopify_api_url,
+                                 resume_attempts=resume_attempts,
+                                 projection_fp=projection_fp)
+
+  if query is None:
+    query = build_export_query(updated_since, projection_fp=projection_fp)
+
+  if stream_download:
+    # bulk output lines are parsed as they are downloaded, optionally saving a copy along the way
+    jsonl_url, job_id = get_shopify_jsonl_url(shopify_url, api_version, shopify_pat,
+                                              expected_object_count=expected_object_count,
+                                              stats=stats,
+                                              query=query,
+                                              operation_name=operation_name,
+                                              api_url=shopify_api_url)
+    tee_fp = output_dir + "/" + filename if save_bulk_file else None
+    return partial(iter_download_lines, jsonl_url, tee_fp, compression), job_id
+
+  return get_shopify_jsonl_fp(shopify_url, api_version,
+                              shopify_pat, output_dir, run_num=run_num,
+                              compression=compression,
+                              expected_object_count=expected_object_count,
+                              stats=stats,
+                              query=query,
+                              operation_name=operation_name,
+                              filename=filename,
+                              api_url=shopify_api_url)
+
+
+# stages of the bulk operation, from the stats of the export
+def add_export_metrics(metrics, stats):
+  attached = stats.get("attached")
+  set_stage(metrics, "bulk_submit", seconds=stats.get("submitSeconds"), polls=stats.get("submitPolls"), attached=None if attached is None else int(attached))
+  set_stage(metrics, "bulk_poll", seconds=stats.get("seconds"), polls=stats.get("polls"), records_out=stats.get("objectCount"), resumes=stats.get("resumes"))
+  # a streamed download overlaps the pipeline, so it is part of the shopify_products stage instead
+  if "downloadSeconds" in stats:
+    set_stage(metrics, "download", seconds=stats["downloadSeconds"], bytes_out=stats["downloadBytes"], records_out=stats.get("objectCount"))
+
+
+# a stage per transform from the accumulated per product timings, with the bytes of their files when written
+def add_pipeline_metrics(metrics, timings, bulk_fp, br_patch_fp, tap_fps):
+  add_timings(metrics, timings)
+  for name, fp in tap_fps.items():
+    set_stage(metrics, name, bytes_out=file_size(fp))
+  set_stage(metrics, "pipeline", bytes_in=file_size(bulk_fp), bytes_out=file_size(br_patch_fp))
+  if timings:
+    set_stage(metrics, "shopify_products", bytes_in=file_size(bulk_fp))
+    set_stage(metrics, "write_patch", bytes_out=file_size(br_patch_fp))
+
+
+def add_feed_metrics(metrics, stats, stage_suffix=""):
+  if "uploadSeconds" in stats:
+    set_stage(metrics, "upload" + stage_suffix, seconds=stats["uploadSeconds"], bytes_in=stats["uploadBytes"], requests=stats["uploadJobs"])
+    set_stage(metrics, "feed_job_wait" + stage_suffix, seconds=stats["jobWaitSeconds"], polls=stats["jobWaitPolls"])
+
+
+def send_feed(br_patch_fp, br_delta_fp, index_fp, metrics, account_id="", environment="", catalog_name="", token="",
+              api_url=None, delta=False, chunk_bytes=None, concurrency=4, compression=None, stats=None, stage_suffix="",
+              checkpoint_dir=None, attribute_index_fp=None):
+  """
+  Sends a patch to a catalog as a full feed, or in delta mode only the products that changed since the
+  last successful run according to the product hash index at index_fp.
+  A delta sent in parts keeps its upload checkpoint in checkpoint_dir, so a rerun resumes the upload.
+
+  Once sent, the fast sync attribute hash index at attribute_index_fp, if there is one, is rebuilt from the patch.
+  """
+  if not delta:
+    patch_catalog(br_patch_fp,
+                  account_id=account_id,
+                  environment_name=environment,
+                  catalog_name=catalog_name,
+                  token=token,
+                  api_url=api_url,
+                  stats=stats)
+  # the first run without an index sends a full feed to establish one
+  elif path.exists(index_fp):
+    with record_stage(metrics, "delta" + stage_suffix) as stage:
+      adds, removes = create_delta(br_patch_fp, br_delta_fp, index_fp, compression=compression)
+      stage["records_out"] = adds + removes
+    set_stage(metrics, "delta" + stage_suffix, bytes_out=file_size(br_delta_fp))
+
+    if adds or removes:
+      patch_catalog(br_delta_fp,
+                    account_id=account_id,
+                    environment_name=environment,
+                    catalog_name=catalog_name,
+                    token=token,
+                    delta=True,
+                    chunk_bytes=chunk_bytes,
+                    concurrency=concurrency,
+                    api_url=api_url,
+                    stats=stats,
+                    checkpoint_dir=checkpoint_dir)
+    else:
+      logger.info("No products changed since the last run, skipping delta feed")
+  else:
+    logger.info("No product hash index found at %s, sending a full feed", index_fp)
+    create_index(br_patch_fp, index_fp)
+    patch_catalog(br_patch_fp,
+                  account_id=account_id,
+                  environment_name=environment,
+                  catalog_name=catalog_name,
+                  token=token,
+                  api_url=api_url,
+                  stats=stats)
+
+  if delta:
+    commit_index(index_fp)
+
+  # the catalog now holds the attribute values of the patch rather than those the fast syncs sent last
+  if attribute_index_fp and path.exists(attribute_index_fp):
+    rebuild_attribute_index(br_patch_fp, attribute_index_fp)
+
+
+# settings a catalog target of a fan-out run may set
+CATALOG_KEYS = ["name", "catalog_name", "environment", "account_id", "api_token", "api_token_env", "api_url",
+                "shopify_url", "pid_props", "vid_props", "mapping_file", "delta"]
+
+
+def load_catalogs(catalogs_fp, defaults):
+  """
+  Reads a json list of catalog targets for a fan-out run. Each target has a "catalog_name", and may set a "name"
+  to tell apart targets of the same catalog name, e.g. in different environments, which defaults to the catalog name
+  and is used in file names and metrics. Targets may also set the "environment", "account_id", "api_token" (or "api_token_env", the name of an environment variable holding it),
+  "api_url", "shopify_url", "pid_props", "vid_props", "mapping_file" and "delta" of its catalog.
+  Anything a target doesn't set is taken from defaults, and any other setting raises a ValueError.
+  """
+  with open(catalogs_fp, "rb") as file:
+    config = loads(file.read())
+
+  targets = []
+  for catalog in config:
+    if not catalog.get("catalog_name"):
+      raise ValueError("Catalog target without a catalog_name in %s" % catalogs_fp)
+    unknown = set(catalog) - set(CATALOG_KEYS)
+    if unknown:
+      raise ValueError("Unknown settings of catalog target %s in %s: %s" % (catalog.get("name") or catalog["catalog_name"], catalogs_fp, ", ".join(sorted(unknown))))
+    target = dict(defaults, name=catalog["catalog_name"])
+    target.update({k: v for k, v in catalog.items() if k not in ["mapping_file", "api_token_env"]})
+    if "mapping_file" in catalog:
+      target["mapping_fp"] = catalog["mapping_file"]
+    if "api_token_env" in catalog:
+      target["api_token"] = getenv(catalog["api_token_env"])
+    targets.append(target)
+
+  if len({target["name"] for target in targets}) < len(targets):
+    raise ValueError("Catalog target names must be unique in %s" % catalogs_fp)
+  return targets
+
+
+def run_fast_sync(shopify_url, shopify_pat, api_version, br_account_id, br_catalog_name, br_environment, br_api_token,
+                  output_dir, run_num, state_dir="", patch_compression=None, intermediate_compression=None,
+                  chunk_bytes=None, concurrency=4, api_url=None, stream_download=False, save_bulk_file=True,
+                  metrics_textfile=None, mapping_fp=None, shards=1, shopify_api_url=None, resume_attempts=0):
+  """
+  Keeps the price and availability attributes of the catalog up to date in between full runs.
+
+  Exports only the fields they depend on, maps them with the same rules as a full run and sends
+  attribute level operations for the attributes that changed since the last fast sync as a delta feed.
+  Attributes that are no longer set, such as the sale price of a sale that ended, are removed.
+
+  Only products in the product hash index of the full delta runs are patched, new and deleted products
+  are left to the full runs. Without an index, every exported product is patched.
+  """
+  export_stats = {}
+  shopify_jsonl, job_id = export_shopify_jsonl(shopify_url, shopify_pat, api_version, output_dir, run_num,
+                                               stream_download=stream_download,
+                                               save_bulk_file=save_bulk_file,
+                                               compression=intermediate_compression,
+                                               stats=export_stats,
+                                               filename="0_shopify_fast_sync_op.jsonl.gz",
+                                               shards=shards,
+                                               shopify_api_url=shopify_api_url,
+                                               resume_attempts=resume_attempts,
+                                               projection_fp=FAST_SYNC_PROJECTION_FP)
+
+  metrics = {}
+  add_export_metrics(metrics, export_stats)
+
+  # products in the catalog as of the last full delta run
+  product_paths = load_product_paths(f"{state_dir or output_dir}/{br_catalog_name}_product_hashes.tsv.gz")
+
+  attribute_patch_fp = f"{output_dir}/{run_num}_{job_id}_4_br_attribute_patch.jsonl"
+  with record_stage(metrics, "pipeline") as stage:
+    stage["records_out"] = create_attribute_patch(shopify_jsonl,
+                                                  attribute_patch_fp,
+                                                  shopify_url,
+                                                  pid_props="handle",
+                                                  vid_props="sku,id",
+                                                  compression=patch_compression,
+                                                  mapping_fp=mapping_fp,
+                                                  product_paths=product_paths)
+  set_stage(metrics, "pipeline", bytes_out=file_size(attribute_patch_fp))
+
+  # attribute operations are compared against those of the last fast sync, the first one sends all of them
+  index_fp = attribute_index_path(state_dir or output_dir, br_catalog_name)
+  br_delta_fp = f"{output_dir}/{run_num}_{job_id}_5_br_attribute_delta.jsonl"
+  with record_stage(metrics, "delta") as stage:
+    # attributes of products no longer in the catalog are dropped from the index without a remove operation
+    adds, removes = create_delta(attribute_patch_fp, br_delta_fp, index_fp, compression=patch_compression, remove_scope=product_paths)
+    stage["records_out"] = adds + removes
+  set_stage(metrics, "delta", bytes_out=file_size(br_delta_fp))
+
+  feed_stats = {}
+  if adds or removes:
+    patch_catalog(br_delta_fp,
+                  account_id=br_account_id,
+                  environment_name=br_environment,
+                  catalog_name=br_catalog_name,
+                  token=br_api_token,
+                  delta=True,
+                  chunk_bytes=chunk_bytes,
+                  concurrency=concurrency,
+                  api_url=api_url,
+                  stats=feed_stats,
+                  checkpoint_dir=state_dir or output_dir)
+  else:
+    logger.info("No price or availability changed since the last fast sync, skipping delta feed")
+  commit_index(index_fp)
+
+  add_feed_metrics(metrics, feed_stats)
+
+  labels = {"shop": shopify_url, "catalog": br_catalog_name, "environment": br_environment, "mode": "fast_sync"}
+  write_json(metrics, f"{output_dir}/{run_num}_{job_id}_run_metrics.json", labels)
+  if metrics_textfile:
+    write_textfile(metrics, metrics_textfile, labels)
+
+
+class Run:
+  """
+  A full or incremental run of a store, split into the phases orchestrator.py schedules on its own:
+  export and send_feeds block on Shopify and Bloomreach, while transform is CPU bound and runs in the
+  worker processes of executor when workers > 1. Settings are the keyword arguments of main.
+
+  A run has a catalog target per catalog of a fan-out run, or a single target otherwise, whose files and
+  metrics stages don't carry its name.
+  """
+
+  def __init__(self, **settings):
+    vars(self).update(settings)
+    # fail before the export rather than when the patch is sent
+    check_compression(self.patch_compression, FEED_CODECS)
+    check_compression(self.intermediate_compression)
+
+    # state is kept in the output directory unless a state directory is set
+    self.state_dir = self.state_dir or self.output_dir
+    self.run_num = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    self.metrics = {}
+    # seconds each transform spent per product, accumulated by stage name
+    self.timings = {}
+    self.failed = []
+
+    # a fan-out run shares the export and aggregation between several catalog targets, each with its own patch and feed
+    self.fanout = bool(self.catalogs_fp)
+    defaults = {
+      "environment": self.br_environment,
+      "account_id": self.br_account_id,
+      "api_token": self.br_api_token,
+      "api_url": self.api_url,
+      "shopify_url": self.shopify_url,
+      "pid_props": "handle",
+      "vid_props": "sku,id",
+      "mapping_fp": self.mapping_fp,
+      "delta": self.delta
+    }
+    if self.fanout:
+      self.targets = load_catalogs(self.catalogs_fp, defaults)
+    else:
+      self.targets = [dict(defaults, name=self.br_catalog_name, catalog_name=self.br_catalog_name)]
+
+  # files of a fan-out run carry the name of their catalog target
+  def target_fp(self, target, step):
+    name = target["name"] + "_" if self.fanout else ""
+    return f"{self.output_dir}/{self.run_num}_{self.job_id}_{name}{step}.jsonl"
+
+  def stage_suffix(self, target):
+    return "." + target["name"] if self.fanout else ""
+
+  def export(self):
+    """
+    Exports the bulk output and, in incremental mode, merges it into the snapshot.
+    """
+    # incremental mode only exports products updated since the last run and merges them into a local snapshot
+    self.snapshot_fp = f"{self.state_dir}/shopify_snapshot.sqlite"
+    db = None
+    updated_since = None
+    if self.incremental:
+      db = snapshot.open_snapshot(self.snapshot_fp)
+      if not self.full_refresh:
+        updated_since = snapshot.get_meta(db, "updated_since")
+      # taken before the export is submitted so updates made while it runs are picked up next time
+      export_started = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # the objectCount of the previous full export lets the poller estimate when this one completes
+    object_count_fp = f"{self.state_dir}/shopify_object_count.txt"
+    expected_object_count = None
+    if updated_since is None and path.exists(object_count_fp):
+      with open(object_count_fp) as file:
+        expected_object_count = int(file.read())
+    export_stats = {}
+
+    self.shopify_jsonl, self.job_id = export_shopify_jsonl(self.shopify_url, self.shopify_pat, self.shopify_api_version, self.output_dir, self.run_num,
+                                                           stream_download=self.stream_download,
+                                                           save_bulk_file=self.save_bulk_file,
+                                                           compression=self.intermediate_compression,
+                                                           expected_object_count=expected_object_count,
+                                                           stats=export_stats,
+                                                           updated_since=updated_since,
+                                                           shards=self.shards,
+                                                           shopify_api_url=self.shopify_api_url,
+                                                           resume_attempts=self.resume_attempts,
+                                                           projection_fp=self.projection_fp)
+
+    if updated_since is None:
+      with open(object_count_fp, "w") as file:
+        file.write(str(export_stats["objectCount"]))
+
+    add_export_metrics(self.metrics, export_stats)
+
+    self.bulk_fp = self.shopify_jsonl if not callable(self.shopify_jsonl) else None
+    if self.stream_download and self.save_bulk_file:
+      self.bulk_fp = f"{self.output_dir}/0_shopify_bulk_op.jsonl.gz"
+
+    if not self.incremental:
+      return
+
+    # a full export replaces the snapshot, which is also complete up to deletions until the next reconciliation
+    with record_stage(self.metrics, "merge_snapshot") as stage:
+      if updated_since is None:
+        db.execute("DELETE FROM products")
+        snapshot.set_meta(db, "reconciled_at", export_started)
+      # merging replaces whole products, so any incomplete product merged before a spilled index fallback is replaced
+      stage["records_out"] = consume_products(self.shopify_jsonl, partial(snapshot.merge_products, db), spill_dir=self.output_dir or None)
+    set_stage(self.metrics, "merge_snapshot", bytes_in=file_size(self.bulk_fp))
+
+    # deleted products don't show up in an updated_at export, so every reconcile_hours
+    # the ids of all live products are exported and any other product is dropped
+    reconciled_at = snapshot.get_meta(db, "reconciled_at")
+    if reconciled_at is None or datetime.utcnow() - datetime.strptime(reconciled_at, "%Y-%m-%dT%H:%M:%SZ") >= timedelta(hours=self.reconcile_hours):
+      with record_stage(self.metrics, "reconcile_snapshot") as stage:
+        product_ids_jsonl, _ = export_shopify_jsonl(self.shopify_url, self.shopify_pat, self.shopify_api_version, self.output_dir, self.run_num,
+                                                    stream_download=True,
+                                                    save_bulk_file=False,
+                                                    query=load_query("export_product_ids_job.graphql"),
+                                                    operation_name="ExportProductIdsJob",
+                                                    shopify_api_url=self.shopify_api_url)
+        product_ids = [loads(line)["id"] for line in product_ids_jsonl()]
+        stage["records_in"] = len(product_ids)
+        stage["records_out"] = len(product_ids) - snapshot.reconcile_products(db, product_ids)
+      snapshot.set_meta(db, "reconciled_at", export_started)
+
+    snapshot.set_meta(db, "updated_since", export_started)
+    db.commit()
+    # the snapshot is opened again by the transform, which may run in another thread
+    db.close()
+
+  def transform(self):
+    """
+    Writes the patch of every catalog target from the bulk output, or from the snapshot in incremental mode.
+    """
+    for target in self.targets:
+      target["patch_fp"] = self.target_fp(target, "4_br_patch")
+
+    # intermediate files are optional debug taps, the patch is built in a single pass
+    tap_fps = {}
+    if self.write_intermediates and self.fanout:
+      logger.warning("Intermediate files aren't written in fan-out runs")
+    elif self.write_intermediates:
+      tap_fps = {
+        "shopify_products": self.target_fp({}, "1_shopify_products"),
+        "generic_products": self.target_fp({}, "2_generic_products"),
+        "br_products": self.target_fp({}, "3_br_products")
+      }
+
+    db = snapshot.open_snapshot(self.snapshot_fp) if self.incremental else None
+    try:
+      with record_stage(self.metrics, "pipeline") as stage:
+        stage["records_out"] = run_pipeline(None if self.incremental else self.shopify_jsonl,
+                                            self.targets,
+                                            workers=self.workers,
+                                            compression=self.patch_compression,
+                                            tap_fps=tap_fps,
+                                            tap_compression=self.intermediate_compression,
+                                            timings=self.timings,
+                                            db=db,
+                                            spill_dir=self.output_dir or None,
+                                            executor=self.executor)
+    finally:
+      if db is not None:
+        db.close()
+
+    # in incremental mode the bulk output is read by the merge instead of the pipeline
+    add_pipeline_metrics(self.metrics, self.timings, None if self.incremental else self.bulk_fp, None if self.fanout else self.targets[0]["patch_fp"], tap_fps)
+    if self.fanout:
+      for target in self.targets:
+        set_stage(self.metrics, "write_patch." + target["name"], bytes_out=file_size(target["patch_fp"]))
+
+  def send_target_feed(self, target):
+    """
+    Sends the patch of a catalog target. A failing feed is logged and added to failed instead of raised,
+    so it doesn't stop the feeds of the other catalogs.
+    """
+    feed_stats = {}
+    try:
+      send_feed(target["patch_fp"],
+                self.target_fp(target, "5_br_delta"),
+                f"{self.state_dir}/{target['name']}_product_hashes.tsv.gz",
+                self.metrics,
+                account_id=target["account_id"],
+                environment=target["environment"],
+                catalog_name=target["catalog_name"],
+                token=target["api_token"],
+                api_url=target["api_url"],
+                delta=target["delta"],
+                chunk_bytes=self.chunk_bytes,
+                concurrency=self.concurrency,
+                compression=self.patch_compression,
+                stats=feed_stats,
+                stage_suffix=self.stage_suffix(target),
+                checkpoint_dir=self.state_dir,
+                attribute_index_fp=attribute_index_path(self.state_dir, target["catalog_name"]) if not self.fanout else None)
+    except Exception:
+      logger.exception("Feed of catalog %s failed", target["name"])
+      self.failed.append(target["name"])
+    add_feed_metrics(self.metrics, feed_stats, stage_suffix=self.stage_suffix(target))
+
+  def send_feeds(self):
+    for target in self.targets:
+      self.send_target_feed(target)
+
+  def finish(self):
+    """
+    Writes the run metrics and raises when a feed failed.
+    """
+    labels = {"shop": self.shopify_url, "catalog": ",".join(target["name"] for target in self.targets), "environment": self.br_environment}
+    write_json(self.metrics, f"{self.output_dir}/{self.run_num}_{self.job_id}_run_metrics.json", labels)
+    # the textfile marks the run as the last successful one, so it is left as it is when a feed failed
+    if self.failed:
+      raise RuntimeError("Feeds of catalogs %s failed" % ", ".join(self.failed))
+    if self.metrics_textfile:
+      write_textfile(self.metrics, self.metrics_textfile, labels)
 
 
 def main(shopify_url="",
@@ -15,30 +635,60 @@ def main(shopify_url="",
          br_catalog_name="",
          br_environment="",
          br_api_token="",
-         output_dir=""):
-
-  run_num = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-  api_version = '2025-04'
-  shopify_jsonl_fp, job_id = get_shopify_jsonl_fp(shopify_url, api_version,
-                                          shopify_pat, output_dir, run_num=run_num)
-
-  shopify_products_fp = f"{output_dir}/{run_num}_{job_id}_1_shopify_products.jsonl"
-  generic_products_fp = f"{output_dir}/{run_num}_{job_id}_2_generic_products.jsonl"
-  br_products_fp = f"{output_dir}/{run_num}_{job_id}_3_br_products.jsonl"
-  br_patch_fp = f"{output_dir}/{run_num}_{job_id}_4_br_patch.jsonl"
-
-  shopifyProducts(shopify_jsonl_fp, shopify_products_fp)
-  brGenerics(shopify_products_fp,
-             generic_products_fp,
-             pid_props="handle",
-             vid_props="sku,id")
-  brProducts(generic_products_fp, br_products_fp, shopify_url)
-  brPatch(br_products_fp, br_patch_fp)
-  patch_catalog(br_patch_fp,
-                account_id=br_account_id,
-                environment_name=br_environment,
-                catalog_name=br_catalog_name,
-                token=br_api_token)
+         output_dir="",
+         write_intermediates=False,
+         workers=1,
+         patch_compression=None,
+         intermediate_compression=None,
+         delta=False,
+         state_dir="",
+         chunk_bytes=None,
+         concurrency=4,
+         api_url=None,
+         stream_download=False,
+         save_bulk_file=True,
+         incremental=False,
+         full_refresh=False,
+         reconcile_hours=24,
+         metrics_textfile=None,
+         mapping_fp=None,
+         shards=1,
+         shopify_api_version="2025-04",
+         shopify_api_url=None,
+         resume_attempts=0,
+         projection_fp=None,
+         fast_sync=False,
+         catalogs_fp=None,
+         executor=None):
+  settings = dict(locals())
+
+  if fast_sync:
+    if catalogs_fp:
+      raise ValueError("Fast sync runs don't support a catalogs file")
+    check_compression(patch_compression, FEED_CODECS)
+    check_compression(intermediate_compression)
+    run_fast_sync(shopify_url, shopify_pat, shopify_api_version, br_account_id, br_catalog_name, br_environment, br_api_token,
+                  output_dir, datetime.utcnow().strftime("%Y%m%d_%H%M%S"),
+                  state_dir=state_dir,
+                  patch_compression=patch_compression,
+                  intermediate_compression=intermediate_compression,
+                  chunk_bytes=chunk_bytes,
+                  concurrency=concurrency,
+                  api_url=api_url,
+                  stream_download=stream_download,
+                  save_bulk_file=save_bulk_file,
+                  metrics_textfile=metrics_textfile,
+                  mapping_fp=mapping_fp,
+                  shards=shards,
+                  shopify_api_url=shopify_api_url,
+                  resume_attempts=resume_attempts)
+    return
+
+  run = Run(**settings)
+  run.export()
+  run.transform()
+  run.send_feeds()
+  run.finish()
 
 
 if __name__ == '__main__':
@@ -55,7 +705,7 @@ if __name__ == '__main__':
   )
 
   parser = argparse.ArgumentParser(
-    description="Extracts a full set of products and their categories from the shopify store and runs a full feed into a Bloomreach Discovery catalog.\n \nUses Shopify's GraphQL Bulk Operation API.\n \nDuring processing, it will save the Shopify bulk operation output jsonl file locally named with the BulkOperation ID value.\n \n From there, the file will run through different transforms to create a Bloomreach patch that is then run in full feed mode via the BR Feed API.\n \nEach transform step will save its intermediate output locally as well for debugging purposes prefixed with a step number.\n \nFor example:\n23453245234_0.jsonl\n23453245234_1_shopify_products.jsonl\n23453245234_2_generic_products.jsonl\n23453245234_3_br_products.jsonl\n23453245234_4_br_patch.jsonl"
+    description="Extracts a full set of products and their categories from the shopify store and runs a full feed into a Bloomreach Discovery catalog.\n \nUses Shopify's GraphQL Bulk Operation API.\n \nDuring processing, it will save the Shopify bulk operation output jsonl file locally named with the BulkOperation ID value.\n \n From there, the file will run through different transforms to create a Bloomreach patch that is then run in full feed mode via the BR Feed API.\n \nWhen --write-intermediates is set, each transform step will save its intermediate output locally as well for debugging purposes prefixed with a step number.\n \nFor example:\n23453245234_0.jsonl\n23453245234_1_shopify_products.jsonl\n23453245234_2_generic_products.jsonl\n23453245234_3_br_products.jsonl\n23453245234_4_br_patch.jsonl"
   )
   
   parser.add_argument(
@@ -92,10 +742,10 @@ if __name__ == '__main__':
 
   parser.add_argument(
     "--br-catalog-name",
-    help="Which Bloomreach Catalog Name to send catalog data to.\nThis is the same as the value of domain_key parameter in Search API requests.",
+    help="Which Bloomreach Catalog Name to send catalog data to.\nThis is the same as the value of domain_key parameter in Search API requests.\nNot needed with --catalogs-file.",
     type=str,
     default=getenv("BR_CATALOG_NAME"),
-    required=not getenv("BR_CATALOG_NAME")
+    required=False
   )
 
   parser.add_argument(
@@ -114,7 +764,191 @@ if __name__ == '__main__':
     required=not getenv("BR_OUTPUT_DIR")
   )
 
+  parser.add_argument(
+    "--write-intermediates",
+    help="Save the output of each transform step locally for debugging purposes. By default only the bulk operation output and the final patch are written.",
+    action="store_true",
+    default=bool(getenv("BR_WRITE_INTERMEDIATES"))
+  )
+
+  parser.add_argument(
+    "--workers",
+    help="Number of worker processes to aggregate and transform products with. Output is identical to the default single process run.",
+    type=int,
+    default=int(getenv("BR_WORKERS", "1")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--patch-compression",
+    help="Compression of the patch file sent to the feed API: gzip[:level] or none. Defaults to gzip:6.",
+    type=str,
+    default=getenv("BR_PATCH_COMPRESSION"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--intermediate-compression",
+    help="Compression of the bulk operation output and intermediate files: gzip[:level], zstd[:level] or none. Defaults to gzip:6.",
+    type=str,
+    default=getenv("BR_INTERMEDIATE_COMPRESSION"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--delta",
+    help="Send only the products that were added, changed or deleted since the last successful run as a delta feed. Falls back to a full feed when there is no product hash index from a previous run.",
+    action="store_true",
+    default=bool(getenv("BR_DELTA"))
+  )
+
+  parser.add_argument(
+    "--state-dir",
+    help="Directory path to keep the product hash index used by --delta between runs. Defaults to the output directory.",
+    type=str,
+    default=getenv("BR_STATE_DIR", ""),
+    required=False
+  )
+
+  parser.add_argument(
+    "--chunk-size-mb",
+    help="Split a delta feed patch into parts of about this many megabytes uncompressed, sent concurrently and resumable on rerun. By default the patch is sent in a single request.",
+    type=float,
+    default=float(getenv("BR_CHUNK_SIZE_MB", "0")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--concurrency",
+    help="Number of patch parts to upload concurrently",
+    type=int,
+    default=int(getenv("BR_UPLOAD_CONCURRENCY", "4")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--br-api-url",
+    help="Base URL of the feed API, e.g. http://localhost:8080/dataconnect/api/v1 for a local stand-in. Defaults to the Bloomreach API of the environment.",
+    type=str,
+    default=getenv("BR_API_URL"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--stream-download",
+    help="Aggregate and transform the bulk operation output while it downloads instead of after saving it to disk",
+    action="store_true",
+    default=bool(getenv("BR_STREAM_DOWNLOAD"))
+  )
+
+  parser.add_argument(
+    "--no-bulk-file",
+    help="With --stream-download, don't save a copy of the bulk operation output",
+    action="store_true",
+    default=bool(getenv("BR_NO_BULK_FILE"))
+  )
+
+  parser.add_argument(
+    "--incremental",
+    help="Only export products updated since the last run and merge them into a local snapshot of all products, which the full patch is rebuilt from. The first run exports every product.",
+    action="store_true",
+    default=bool(getenv("BR_INCREMENTAL"))
+  )
+
+  parser.add_argument(
+    "--full-refresh",
+    help="With --incremental, export every product and replace the snapshot",
+    action="store_true",
+    default=bool(getenv("BR_FULL_REFRESH"))
+  )
+
+  parser.add_argument(
+    "--reconcile-hours",
+    help="With --incremental, how often to export the ids of all products to drop deleted products from the snapshot",
+    type=float,
+    default=float(getenv("BR_RECONCILE_HOURS", "24")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--metrics-textfile",
+    help="File to also write the run metrics to in the Prometheus text format, e.g. in the node exporter textfile collector directory. Metrics are always written to a run_metrics.json file in the output directory.",
+    type=str,
+    default=getenv("BR_METRICS_TEXTFILE"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--mapping-file",
+    help="File path of a json mapping config of Bloomreach product and variant attributes. Defaults to src/mappings/default.json.",
+    type=str,
+    default=getenv("BR_MAPPING_FILE"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--shards",
+    help="Split the products export into this many bulk operations over ranges of product ids, run side by side and merged. Needs a Shopify API version that allows concurrent bulk operations.",
+    type=int,
+    default=int(getenv("BR_SHARDS", "1")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--shopify-api-version",
+    help="Shopify Admin API version, e.g. 2026-01",
+    type=str,
+    default=getenv("BR_SHOPIFY_API_VERSION", "2025-04"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--shopify-api-url",
+    help="Base URL of the Shopify Admin API, e.g. http://localhost:8081/admin/api/2025-04 for a local stand-in. Defaults to the Admin API of the shop.",
+    type=str,
+    default=getenv("BR_SHOPIFY_API_URL"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--resume-attempts",
+    help="When the products export fails, salvage its partial data and export the remaining products, up to this many times, instead of failing the run",
+    type=int,
+    default=int(getenv("BR_RESUME_ATTEMPTS", "0")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--projection-file",
+    help="File path of a json projection config of the product, variant, collection and metafield fields to export from Shopify. Defaults to src/projections/default.json.",
+    type=str,
+    default=getenv("BR_PROJECTION_FILE"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--fast-sync",
+    help="Only sync the price and availability attributes of products and variants that changed since the last fast sync, with attribute level delta operations, e.g. every few minutes in between full runs",
+    action="store_true",
+    default=bool(getenv("BR_FAST_SYNC"))
+  )
+
+  parser.add_argument(
+    "--catalogs-file",
+    help="File path of a json list of catalog targets to fan a single export out to, each with its own patch and feed. Targets take anything they don't set, such as the environment, account id or api token, from the other options.",
+    type=str,
+    default=getenv("BR_CATALOGS_FILE"),
+    required=False
+  )
+
   args = parser.parse_args()
+  if not args.br_catalog_name and not args.catalogs_file:
+    parser.error("the following arguments are required: --br-catalog-name")
+  try:
+    check_compression(args.patch_compression, FEED_CODECS)
+    check_compression(args.intermediate_compression)
+  except (ValueError, ImportError) as e:
+    parser.error(str(e))
   shopify_url = args.shopify_url
   shopify_pat = args.shopify_pat
   environment = args.br_environment
@@ -122,6 +956,29 @@ if __name__ == '__main__':
   catalog_name = args.br_catalog_name
   api_token = args.br_api_token
   output_dir = args.output_dir
+  write_intermediates = args.write_intermediates
+  workers = args.workers
+  patch_compression = args.patch_compression
+  intermediate_compression = args.intermediate_compression
+  delta = args.delta
+  state_dir = args.state_dir
+  chunk_bytes = int(args.chunk_size_mb * 1024 * 1024)
+  concurrency = args.concurrency
+  api_url = args.br_api_url
+  stream_download = args.stream_download
+  save_bulk_file = not args.no_bulk_file
+  incremental = args.incremental
+  full_refresh = args.full_refresh
+  reconcile_hours = args.reconcile_hours
+  metrics_textfile = args.metrics_textfile
+  mapping_fp = args.mapping_file
+  shards = args.shards
+  shopify_api_version = args.shopify_api_version
+  shopify_api_url = args.shopify_api_url
+  resume_attempts = args.resume_attempts
+  projection_fp = args.projection_file
+  fast_sync = args.fast_sync
+  catalogs_fp = args.catalogs_file
 
   main(shopify_url=shopify_url,
        shopify_pat=shopify_pat,
@@ -129,7 +986,30 @@ if __name__ == '__main__':
        br_account_id=account_id,
        br_catalog_name=catalog_name,
        br_api_token=api_token,
-       output_dir=output_dir)
+       output_dir=output_dir,
+       write_intermediates=write_intermediates,
+       workers=workers,
+       patch_compression=patch_compression,
+       intermediate_compression=intermediate_compression,
+       delta=delta,
+       state_dir=state_dir,
+       chunk_bytes=chunk_bytes,
+       concurrency=concurrency,
+       api_url=api_url,
+       stream_download=stream_download,
+       save_bulk_file=save_bulk_file,
+       incremental=incremental,
+       full_refresh=full_refresh,
+       reconcile_hours=reconcile_hours,
+       metrics_textfile=metrics_textfile,
+       mapping_fp=mapping_fp,
+       shards=shards,
+       shopify_api_version=shopify_api_version,
+       shopify_api_url=shopify_api_url,
+       resume_attempts=resume_attempts,
+       projection_fp=projection_fp,
+       fast_sync=fast_sync,
+       catalogs_fp=catalogs_fp)
 
 # TODO: add a dry-run mode
 # TODO: add counters to each module and provide examples of invalid
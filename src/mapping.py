@@ -0,0 +1,336 @@
+import logging
+import re
+from functools import lru_cache
+from os import getenv, path
+from codec import loads
+
+logger = logging.getLogger(__name__)
+
+MAPPINGS_DIR = path.join(path.dirname(path.abspath(__file__)), "mappings")
+DEFAULT_MAPPING_FP = path.join(MAPPINGS_DIR, "default.json")
+
+# named value transforms a rule may apply
+TRANSFORMS = {
+  "strip": str.strip,
+  "lower": str.lower,
+  "upper": str.upper,
+  "str": str,
+  "int": int,
+  "float": float,
+}
+
+TEMPLATE_FIELD = re.compile(r"\{([^{}]+)\}")
+
+# the keys a rule may have, by the key setting its value
+RULE_KEYS = {
+  "options": {"source", "options", "match", "when"},
+  "value": {"target", "value", "when", "else"},
+  "template": {"target", "template", "transform", "skip_empty", "when", "else"},
+  "source": {"target", "source", "fallback", "path", "transform", "skip_empty", "when", "else"},
+}
+
+CONDITION_CHECKS = {"equals", "not_equals", "equals_source", "not_equals_source", "gt", "lt", "in", "truthy"}
+
+
+@lru_cache(maxsize=None)
+def load_mapping(shopify_url, mapping_fp=None):
+  """
+  Reads and compiles a mapping config once per process, returning a function transforming a generic
+  product into a Bloomreach product. mapping_fp defaults to BR_MAPPING_FILE, then to the default mapping.
+  """
+  mapping_fp = mapping_fp or getenv("BR_MAPPING_FILE") or DEFAULT_MAPPING_FP
+  with open(mapping_fp, "rb") as file:
+    config = loads(file.read())
+
+  logger.info("Compiled product mapping: %s", mapping_fp)
+  return compile_mapping(config, {"shopify_url": shopify_url})
+
+
+def compile_mapping(config, variables=None):
+  """
+  Compiles a mapping config into a function transforming a generic product into a Bloomreach product.
+
+  The config has a list of "product" rules and a list of "variant" rules, applied in order to a copy of
+  the product and each variant's attributes. A rule sets its "target" attribute to one of:
+    "value": a constant
+    "template": a string with {attribute} or {variable} fields, e.g. "https://{shopify_url}/products/{sp.handle}"
+    "source": an attribute, optionally followed through the keys in "path" of a nested value,
+              falling back to the "fallback" attribute when it is missing or falsy
+    "options": a map of option names to target attributes, set from the name/value pairs in "source",
+              matching names that contain the option name, or are equal to it when "match" is "exact"
+
+  "transform" names a function from TRANSFORMS applied to the value, and "skip_empty" skips empty strings.
+  When the "when" conditions don't all hold, the rule sets the "else" value if there is one, otherwise nothing.
+  A rule whose value can't be resolved sets nothing.
+
+  The config is validated up front, raising a ValueError naming the rule's target for unknown keys, transforms
+  or checks. Every rule is then compiled once into a function setting its target, so transforming a product
+  only runs through the list of compiled rules without looking at the config.
+  """
+  validate_mapping(config)
+  variables = variables or {}
+  product_rules = [compile_rule(rule, variables) for rule in config.get("product", [])]
+  variant_rules = [compile_rule(rule, variables) for rule in config.get("variant", [])]
+
+  def create_product(product):
+    in_pa = product["attributes"]
+    out_pa = in_pa.copy()
+    for rule in product_rules:
+      rule(in_pa, out_pa)
+
+    variants = {}
+    for v_id, variant in product["variants"].items():
+      in_va = variant["attributes"]
+      out_va = in_va.copy()
+      for rule in variant_rules:
+        rule(in_va, out_va)
+      variants[v_id] = {"attributes": out_va}
+    return {"id": product["id"], "attributes": out_pa, "variants": variants}
+
+  return create_product
+
+
+def validate_mapping(config):
+  if not isinstance(config, dict):
+    raise ValueError("Mapping config must be an object with product and variant rules")
+  unknown = set(config) - {"product", "variant"}
+  if unknown:
+    raise ValueError("Unknown mapping config keys: %s" % ", ".join(sorted(unknown)))
+
+  for scope in ["product", "variant"]:
+    if not isinstance(config.get(scope, []), list):
+      raise ValueError("Mapping config %s rules must be a list" % scope)
+    for index, rule in enumerate(config.get(scope, [])):
+      validate_rule(rule, scope, index)
+
+
+def validate_rule(rule, scope, index):
+  name = "#%s" % index
+  if isinstance(rule, dict):
+    name = repr(rule.get("target") or rule.get("source") or name)
+
+  def fail(problem):
+    raise ValueError("Invalid %s mapping rule %s: %s" % (scope, name, problem))
+
+  if not isinstance(rule, dict):
+    fail("rules must be objects")
+
+  kind = next((key for key in RULE_KEYS if key in rule), None)
+  if kind is None:
+    fail("needs one of %s" % ", ".join(RULE_KEYS))
+  unknown = set(rule) - RULE_KEYS[kind]
+  if unknown:
+    fail("unknown keys for %s rules: %s" % (kind, ", ".join(sorted(unknown))))
+
+  if kind != "options" and not isinstance(rule.get("target"), str):
+    fail("target must be an attribute name")
+  for key in ["source", "fallback", "template"]:
+    if key in rule and not isinstance(rule[key], str):
+      fail("%s must be a string" % key)
+  if "fallback" in rule and "path" in rule:
+    fail("fallback and path can't be combined")
+  if "path" in rule and not (isinstance(rule["path"], list) and all(isinstance(key, str) for key in rule["path"])):
+    fail("path must be a list of keys")
+  if "transform" in rule and rule["transform"] not in TRANSFORMS:
+    fail("unknown transform %r, expected one of %s" % (rule["transform"], ", ".join(TRANSFORMS)))
+
+  if kind == "options":
+    if not isinstance(rule["options"], dict) or not all(isinstance(v, str) for v in rule["options"].values()):
+      fail("options must map option names to attribute names")
+    if rule.get("match", "contains") not in ["contains", "exact"]:
+      fail("match must be contains or exact")
+
+  conditions = rule.get("when", [])
+  if not isinstance(conditions, list):
+    fail("when must be a list of conditions")
+  for condition in conditions:
+    if not isinstance(condition, dict) or not isinstance(condition.get("source"), str):
+      fail("conditions must be objects with a source attribute")
+    checks = set(condition) - {"source"}
+    if len(checks) != 1 or not checks <= CONDITION_CHECKS:
+      fail("conditions on %r need exactly one of %s, found: %s" % (condition["source"], ", ".join(sorted(CONDITION_CHECKS)), ", ".join(sorted(checks)) or "none"))
+    if "in" in condition and not isinstance(condition["in"], list):
+      fail("in of the condition on %r must be a list" % condition["source"])
+
+
+# returns a function(ins, out) applying the rule to the input attributes ins, setting its target in out
+def compile_rule(rule, variables):
+  apply = compile_options(rule) if "options" in rule else compile_value(rule, variables)
+  condition = compile_condition(rule.get("when", []))
+  if condition is None:
+    return apply
+
+  if "else" not in rule:
+    def apply_when(ins, out):
+      if condition(ins):
+        apply(ins, out)
+    return apply_when
+
+  target = rule["target"]
+  otherwise = rule["else"]
+
+  def apply_when_else(ins, out):
+    if condition(ins):
+      apply(ins, out)
+    else:
+      out[target] = otherwise
+  return apply_when_else
+
+
+def compile_value(rule, variables):
+  target = rule["target"]
+  if "value" in rule:
+    constant = rule["value"]
+
+    def set_value(ins, out):
+      out[target] = constant
+    return set_value
+
+  resolve = compile_resolve(rule, variables)
+  transform = TRANSFORMS.get(rule.get("transform"))
+  skip_empty = rule.get("skip_empty", False)
+
+  # resolve returns a (found, value) pair, a rule whose value isn't found sets nothing
+  def set_resolved(ins, out):
+    found, value = resolve(ins)
+    if not found:
+      return
+    if transform is not None:
+      value = transform(value)
+    if skip_empty and value == "":
+      return
+    out[target] = value
+  return set_resolved
+
+
+def compile_resolve(rule, variables):
+  source = rule.get("source")
+  if "template" in rule:
+    return compile_template(rule["template"], variables)
+
+  if "fallback" in rule:
+    fallback = rule["fallback"]
+
+    def resolve_fallback(ins):
+      value = ins.get(source)
+      if not value:
+        value = ins.get(fallback, value)
+      return value is not None, value
+    return resolve_fallback
+
+  if "path" in rule:
+    keys = tuple(rule["path"])
+
+    def resolve_path(ins):
+      value = ins.get(source)
+      for key in keys:
+        if not (isinstance(value, dict) and key in value):
+          return False, None
+        value = value[key]
+      return True, value
+    return resolve_path
+
+  def resolve_source(ins):
+    if source in ins:
+      return True, ins[source]
+    return False, None
+  return resolve_source
+
+
+# splits the template into literals and attribute fields once, variables are filled in up front
+#   a template with a missing attribute field isn't found
+def compile_template(template, variables):
+  parts = []
+  literal = ""
+  position = 0
+  for match in TEMPLATE_FIELD.finditer(template):
+    literal += template[position:match.start()]
+    field = match.group(1)
+    if field in variables:
+      literal += str(variables[field])
+    else:
+      parts.append((literal, field))
+      literal = ""
+    position = match.end()
+  literal += template[position:]
+  parts = tuple(parts)
+
+  def resolve_template(ins):
+    values = []
+    for prefix, field in parts:
+      value = ins.get(field)
+      if value is None:
+        return False, None
+      values.append(prefix)
+      values.append(str(value))
+    values.append(literal)
+    return True, "".join(values)
+  return resolve_template
+
+
+# conditions are a list of {"source": attribute, <check>: operand} that must all hold,
+#   a condition on a missing attribute doesn't hold
+def compile_condition(conditions):
+  if not conditions:
+    return None
+  checks = tuple(compile_check(condition) for condition in conditions)
+
+  def condition(ins):
+    for check in checks:
+      if not check(ins):
+        return False
+    return True
+  return condition
+
+
+def compile_check(condition):
+  source = condition["source"]
+
+  if "equals" in condition:
+    operand = condition["equals"]
+    return lambda ins: source in ins and ins[source] == operand
+  if "not_equals" in condition:
+    operand = condition["not_equals"]
+    return lambda ins: source in ins and ins[source] != operand
+  if "equals_source" in condition:
+    other = condition["equals_source"]
+    return lambda ins: source in ins and ins[source] == ins.get(other)
+  if "not_equals_source" in condition:
+    other = condition["not_equals_source"]
+    return lambda ins: source in ins and ins[source] != ins.get(other)
+  if "gt" in condition:
+    operand = condition["gt"]
+    return lambda ins: ins.get(source) is not None and ins[source] > operand
+  if "lt" in condition:
+    operand = condition["lt"]
+    return lambda ins: ins.get(source) is not None and ins[source] < operand
+  if "in" in condition:
+    operands = frozenset(condition["in"])
+    return lambda ins: ins.get(source) in operands
+  if condition.get("truthy", True):
+    return lambda ins: bool(ins.get(source))
+  return lambda ins: not ins.get(source)
+
+
+def compile_options(rule):
+  source = rule["source"]
+  targets = dict(rule["options"])
+  exact = rule.get("match", "contains") == "exact"
+
+  def set_options(ins, out):
+    options = ins.get(source)
+    if not options:
+      return
+    for option in options:
+      if "name" not in option or "value" not in option:
+        continue
+      name = option["name"]
+      if exact:
+        target = targets.get(name)
+        if target is not None:
+          out[target] = option["value"]
+        continue
+      for option_name, target in targets.items():
+        if option_name in name:
+          out[target] = option["value"]
+  return set_options
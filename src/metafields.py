@@ -0,0 +1,72 @@
+import logging
+from functools import lru_cache
+from codec import loads
+
+logger = logging.getLogger(__name__)
+
+
+def decode_boolean(value):
+  return value == "true"
+
+
+# metafield values arrive as strings, decoders map a metafield type to its python value
+#   https://shopify.dev/docs/apps/build/custom-data/metafields/list-of-data-types
+#   types that aren't listed, such as text, url, color, date and the reference types, stay strings
+#   number_decimal stays a string too, as a float would round large or high scale decimals and drop trailing zeros
+DECODERS = {
+  "number_integer": int,
+  "boolean": decode_boolean,
+  "json": loads,
+  "money": loads,
+  "dimension": loads,
+  "volume": loads,
+  "weight": loads,
+  "rating": loads,
+}
+
+
+def identity(value):
+  return value
+
+
+@lru_cache(maxsize=None)
+def get_decoder(metafield_type):
+  """
+  Returns the decoder of a metafield type, memoized so each type is only resolved once.
+
+  list.* types are json arrays whose items are already typed json values, such as numbers, strings
+  for text and reference ids, or objects for money, dimension and rating items.
+  """
+  if metafield_type.startswith("list."):
+    return loads
+  return DECODERS.get(metafield_type, identity)
+
+
+# adds the attribute name and decoder of a metafield definition to definitions
+def get_attribute(definitions, prefix, namespace, key, metafield_type):
+  attribute = (prefix + "m." + namespace + "." + key, get_decoder(metafield_type))
+  definitions[(prefix, namespace, key, metafield_type)] = attribute
+  return attribute
+
+
+def add_metafield_attributes(attributes, prefix, metafields, definitions=None):
+  """
+  Adds each metafield to attributes as <prefix>m.<namespace>.<key>, with its value decoded according to its type.
+
+  definitions maps the (prefix, namespace, key, type) of each metafield definition seen so far to its attribute name
+  and decoder, so they are looked up once per definition rather than built for every value. It is owned by whoever
+  transforms the products, as there are only as many as the shop has metafield definitions.
+  Values that don't match their type are kept as they are rather than failing the whole export.
+  """
+  if definitions is None:
+    definitions = {}
+
+  for metafield in metafields:
+    definition = (prefix, metafield["namespace"], metafield["key"], metafield["type"])
+    name, decode = definitions.get(definition) or get_attribute(definitions, *definition)
+    value = metafield["value"]
+    try:
+      attributes[name] = decode(value)
+    except (TypeError, ValueError):
+      logger.debug("Keeping %s metafield %s value as a string: %r", metafield["type"], metafield.get("id"), value)
+      attributes[name] = value
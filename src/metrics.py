@@ -0,0 +1,152 @@
+import json
+import logging
+import resource
+import sys
+from contextlib import contextmanager
+from os import path, replace
+from time import perf_counter, time
+
+logger = logging.getLogger(__name__)
+
+# run metrics map a stage name to a dict of its measurements, such as
+#   seconds, records_in, records_out, bytes_in, bytes_out, polls, max_record_seconds and the running peak RSS
+METRIC_PREFIX = "shopify_export"
+
+METRIC_HELP = {
+  "seconds": "Seconds spent in the stage",
+  "records_in": "Records read by the stage",
+  "records_out": "Records written by the stage",
+  "bytes_in": "Bytes read by the stage",
+  "bytes_out": "Bytes written by the stage",
+  "polls": "Number of status polls made by the stage",
+  "requests": "Number of requests made by the stage",
+  "max_record_seconds": "Longest time the stage spent on a single record",
+  "attached": "1 when the export attached to a bulk operation of the same query that was already running",
+  "resumes": "Number of times a failed bulk operation was resumed from its partial data",
+  "process_peak_rss_bytes": "Peak resident set size of the process since it started, as of the end of the stage. "
+                            "A running maximum over the process, not the peak of the stage or of a single run",
+  "workers_peak_rss_bytes": "Largest peak resident set size of a worker process that exited before the end of the stage. "
+                            "A running maximum, workers of a pool shared by several runs only count once it is shut down",
+}
+
+
+# ru_maxrss is the high water mark of a process, or of the largest reaped child, since it started,
+#   and can't be reset, so these are running maximums as of when they are taken rather than per stage peaks
+def peak_rss(who=resource.RUSAGE_SELF):
+  usage = resource.getrusage(who).ru_maxrss
+  # ru_maxrss is in kilobytes on linux and bytes on macOS
+  return usage if sys.platform == "darwin" else usage * 1024
+
+
+def set_stage(metrics, name, **values):
+  stage = metrics.setdefault(name, {})
+  stage.update({k: v for k, v in values.items() if v is not None})
+  stage["process_peak_rss_bytes"] = peak_rss()
+  stage["workers_peak_rss_bytes"] = peak_rss(resource.RUSAGE_CHILDREN)
+  return stage
+
+
+@contextmanager
+def record_stage(metrics, name):
+  """
+  Times the block as a stage, yielding its dict so counts can be added to it.
+  """
+  start = perf_counter()
+  stage = metrics.setdefault(name, {})
+  try:
+    yield stage
+  finally:
+    set_stage(metrics, name, seconds=perf_counter() - start)
+
+
+def file_size(fp):
+  return path.getsize(fp) if fp and path.exists(fp) else None
+
+
+# timings accumulate per record durations of the transforms, which are too fine grained to time as stages
+def add_timing(timings, name, seconds):
+  if timings is None:
+    return
+
+  timing = timings.get(name)
+  if timing is None:
+    timings[name] = {"seconds": seconds, "records": 1, "max_record_seconds": seconds}
+  else:
+    timing["seconds"] += seconds
+    timing["records"] += 1
+    if seconds > timing["max_record_seconds"]:
+      timing["max_record_seconds"] = seconds
+
+
+# adds the time since start to a timing and returns the current time to start the next one from
+def record_timing(timings, name, start):
+  now = perf_counter()
+  add_timing(timings, name, now - start)
+  return now
+
+
+# times how long each item of an iterable, such as a generator of aggregated products, takes to produce
+def timed(items, timings, name):
+  items = iter(items)
+  while True:
+    start = perf_counter()
+    try:
+      item = next(items)
+    except StopIteration:
+      return
+    record_timing(timings, name, start)
+    yield item
+
+
+def add_timings(metrics, timings):
+  for name, timing in timings.items():
+    set_stage(metrics, name,
+              seconds=timing["seconds"],
+              records_in=timing["records"],
+              records_out=timing["records"],
+              max_record_seconds=timing["max_record_seconds"])
+
+
+def write_json(metrics, fp, labels=None):
+  with open(fp, "w") as file:
+    json.dump({"labels": labels or {}, "timestamp": time(), "stages": metrics}, file, indent=2)
+  logger.info("Wrote run metrics to: %s", fp)
+
+
+def format_labels(labels):
+  if not labels:
+    return ""
+  escaped = (k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in labels.items())
+  return "{" + ",".join(escaped) + "}"
+
+
+def write_textfile(metrics, fp, labels=None):
+  """
+  Writes the metrics in the Prometheus text format for the node exporter textfile collector,
+  with a gauge per measurement labelled by stage, plus the time of the last successful run.
+
+  The file is written next to its destination and renamed so the collector never reads a partial file.
+  """
+  labels = labels or {}
+  lines = []
+  for measurement, help_text in METRIC_HELP.items():
+    stages = [(name, stage[measurement]) for name, stage in metrics.items() if measurement in stage]
+    if not stages:
+      continue
+
+    metric = "%s_stage_%s" % (METRIC_PREFIX, measurement)
+    lines.append("# HELP %s %s" % (metric, help_text))
+    lines.append("# TYPE %s gauge" % metric)
+    for name, value in stages:
+      lines.append("%s%s %s" % (metric, format_labels({**labels, "stage": name}), float(value)))
+
+  metric = "%s_last_success_timestamp_seconds" % METRIC_PREFIX
+  lines.append("# HELP %s Unix time of the last successful run" % metric)
+  lines.append("# TYPE %s gauge" % metric)
+  lines.append("%s%s %s" % (metric, format_labels(labels), time()))
+
+  tmp_fp = fp + ".tmp"
+  with open(tmp_fp, "w") as file:
+    file.write("\n".join(lines) + "\n")
+  replace(tmp_fp, fp)
+  logger.info("Wrote run metrics textfile to: %s", fp)
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from functools import partial
+from inspect import signature
+from os import cpu_count, getenv, makedirs, path
+from time import monotonic
+from codec import loads
+import main
+
+logger = logging.getLogger(__name__)
+
+# secrets a store may read from the environment variable named by <key>_env instead
+SECRET_KEYS = ["shopify_pat", "br_api_token"]
+
+
+def load_stores(stores_fp, output_dir, state_dir=""):
+  """
+  Reads a json list of store runs. Each run is a dict of the keyword arguments of main.main, such as the
+  "shopify_url", "shopify_pat", "br_catalog_name", "delta" or "catalogs_fp" of the run, and may set a "name",
+  which defaults to the shopify url and is used in logs and directory names.
+  "shopify_pat_env" and "br_api_token_env" name environment variables holding the secrets instead.
+
+  Unless a run sets its own, it writes to the directory of its name under output_dir,
+  and keeps its state in the directory of its name under state_dir.
+  Returns a list of (name, keyword arguments) pairs.
+  """
+  with open(stores_fp, "rb") as file:
+    config = loads(file.read())
+
+  parameters = set(signature(main.main).parameters) - {"executor"}
+  stores = []
+  for store in config:
+    store = dict(store)
+    for key in SECRET_KEYS:
+      if key + "_env" in store:
+        store[key] = getenv(store.pop(key + "_env"))
+
+    if not store.get("shopify_url"):
+      raise ValueError("Store without a shopify_url in %s" % stores_fp)
+    name = store.pop("name", None) or store["shopify_url"]
+
+    unknown = set(store) - parameters
+    if unknown:
+      raise ValueError("Unknown settings of store %s in %s: %s" % (name, stores_fp, ", ".join(sorted(unknown))))
+
+    store.setdefault("output_dir", path.join(output_dir, name))
+    if state_dir:
+      store.setdefault("state_dir", path.join(state_dir, name))
+    stores.append((name, store))
+
+  if len({name for name, _ in stores}) < len(stores):
+    raise ValueError("Store names must be unique in %s" % stores_fp)
+  return stores
+
+
+# name of the store whose run is in progress in the current context, added to log records by StoreFilter
+CURRENT_STORE = ContextVar("store", default="-")
+
+
+class StoreFilter(logging.Filter):
+  """
+  Sets the "store" attribute of log records to the name of the store whose run logged them, or "-" outside of a run,
+  so handlers can format records with %(store)s.
+  """
+  def filter(self, record):
+    record.store = CURRENT_STORE.get()
+    return True
+
+
+# a run of a store with the defaults of main.main for the settings it doesn't set
+def create_run(settings):
+  arguments = signature(main.main).bind(**settings)
+  arguments.apply_defaults()
+  return main.Run(**arguments.arguments)
+
+
+async def run_stores(stores, workers=1, max_concurrent=4, max_per_store=2):
+  """
+  Runs the stores concurrently on one event loop, returning the names of the stores whose run failed.
+
+  Runs are scheduled phase by phase, see main.Run. The export and the feeds wait on bulk operations, downloads
+  and feed jobs, which are blocking calls of the Shopify client and requests, so they are moved off the loop to threads.
+  At most max_concurrent of them are in flight at once, and at most max_per_store of a single store, such as the feeds
+  of its catalogs in a fan-out run. Exports of the same shop run one at a time, as its bulk operations and API rate
+  limits are shared. Fast sync runs are scheduled as a whole, like an export.
+
+  Transforms are offloaded to a single pool of worker processes shared by every run, so the CPU used doesn't grow
+  with the number of stores in flight. At most max_concurrent transforms feed the pool at once.
+  """
+  loop = asyncio.get_running_loop()
+  limit = asyncio.Semaphore(max_concurrent)
+  transform_limit = asyncio.Semaphore(max_concurrent)
+  shop_exports = {}
+  failed = []
+
+  with ThreadPoolExecutor(max_workers=2 * max_concurrent) as threads, ProcessPoolExecutor(max_workers=workers) as processes:
+    # worker processes are started up front, before any run thread holds a lock they could inherit
+    list(processes.map(int, range(workers)))
+
+    # blocking calls run in the context of the store whose run made them, so their log records carry its name
+    def in_thread(func, *args):
+      return loop.run_in_executor(threads, partial(copy_context().run, func, *args))
+
+    async def run_blocking(store_limit, func, *args):
+      # a phase waiting on its store doesn't take up one of the global slots
+      async with store_limit, limit:
+        return await in_thread(func, *args)
+
+    async def run_store(name, store):
+      CURRENT_STORE.set(name)
+      store_limit = asyncio.Semaphore(max_per_store)
+      shop_export = shop_exports.setdefault(store["shopify_url"], asyncio.Lock())
+      settings = dict({"workers": workers}, **store, executor=processes)
+
+      logger.info("Store %s: run started", name)
+      start = monotonic()
+      try:
+        makedirs(store["output_dir"], exist_ok=True)
+        if store.get("state_dir"):
+          makedirs(store["state_dir"], exist_ok=True)
+
+        if store.get("fast_sync"):
+          async with shop_export:
+            await run_blocking(store_limit, partial(main.main, **settings))
+        else:
+          run = create_run(settings)
+          async with shop_export:
+            await run_blocking(store_limit, run.export)
+          async with transform_limit:
+            await in_thread(run.transform)
+          await asyncio.gather(*[run_blocking(store_limit, run.send_target_feed, target) for target in run.targets])
+          await in_thread(run.finish)
+      except Exception:
+        # a failing store doesn't stop the runs of the other stores
+        logger.exception("Store %s: run failed after %.1fs", name, monotonic() - start)
+        failed.append(name)
+        return
+      logger.info("Store %s: run completed in %.1fs", name, monotonic() - start)
+
+    await asyncio.gather(*[run_store(name, store) for name, store in stores])
+
+  return failed
+
+
+if __name__ == '__main__':
+  import argparse
+
+  from sys import stdout
+
+  # Define logger
+  loglevel = getenv('LOGLEVEL', 'INFO').upper()
+  logging.basicConfig(
+    stream=stdout,
+    level=loglevel,
+    format="%(name)-12s %(asctime)s %(levelname)-8s %(store)s %(filename)s:%(funcName)s %(message)s"
+  )
+  for handler in logging.getLogger().handlers:
+    handler.addFilter(StoreFilter())
+
+  parser = argparse.ArgumentParser(
+    description="Runs the export and feeds of several Shopify stores concurrently in one process. Each store runs as main.py would with the settings of its entry in the stores file, while the transforms of every store share a single pool of worker processes."
+  )
+
+  parser.add_argument(
+    "--stores-file",
+    help="File path of a json list of store runs, each a dict of main.py settings, e.g. {\"name\": \"store-a\", \"shopify_url\": \"store-a.myshopify.com\", \"shopify_pat_env\": \"STORE_A_PAT\", \"br_catalog_name\": \"store_a\", \"delta\": true}.",
+    type=str,
+    default=getenv("BR_STORES_FILE"),
+    required=not getenv("BR_STORES_FILE")
+  )
+
+  parser.add_argument(
+    "--output-dir",
+    help="Directory to write the files of each store to, in a directory of its name",
+    type=str,
+    default=getenv("BR_OUTPUT_DIR"),
+    required=not getenv("BR_OUTPUT_DIR")
+  )
+
+  parser.add_argument(
+    "--state-dir",
+    help="Directory to keep the state of each store between runs in, in a directory of its name. Defaults to the output directory of the store.",
+    type=str,
+    default=getenv("BR_STATE_DIR", ""),
+    required=False
+  )
+
+  parser.add_argument(
+    "--workers",
+    help="Number of worker processes shared by the transforms of every store. Defaults to the number of CPUs.",
+    type=int,
+    default=int(getenv("BR_WORKERS", str(cpu_count() or 1))),
+    required=False
+  )
+
+  parser.add_argument(
+    "--max-concurrent",
+    help="Number of exports and feeds in flight at once across every store, and of transforms feeding the worker processes",
+    type=int,
+    default=int(getenv("BR_MAX_CONCURRENT", "4")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--max-per-store",
+    help="Number of exports and feeds in flight at once for a single store, such as the feeds of the catalogs of a fan-out run",
+    type=int,
+    default=int(getenv("BR_MAX_PER_STORE", "2")),
+    required=False
+  )
+
+  args = parser.parse_args()
+  stores_fp = args.stores_file
+  output_dir = args.output_dir
+  state_dir = args.state_dir
+  workers = args.workers
+  max_concurrent = args.max_concurrent
+  max_per_store = args.max_per_store
+
+  stores = load_stores(stores_fp, output_dir, state_dir)
+  failed = asyncio.run(run_stores(stores, workers, max_concurrent, max_per_store))
+  if failed:
+    raise RuntimeError("Runs of stores %s failed" % ", ".join(failed))
@@ -0,0 +1,45 @@
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 256
+
+
+def batched(items, batch_size=DEFAULT_BATCH_SIZE):
+  items = iter(items)
+  while True:
+    batch = list(islice(items, batch_size))
+    if not batch:
+      return
+    yield batch
+
+
+def map_batches(func, items, workers, batch_size=DEFAULT_BATCH_SIZE, executor=None):
+  """
+  Applies func to batches of items across a pool of worker processes
+  and yields each batch result in input order.
+
+  func must be picklable (a module level function or a functools.partial of one),
+  take a list of items and return a list of results.
+
+  Only a couple of batches per worker are in flight at any time,
+  so the input is consumed lazily and memory doesn't grow with the input size.
+
+  When an executor is passed, batches are submitted to it instead of a pool of its own,
+  e.g. a pool shared by several runs, and it is left running afterwards.
+  """
+  max_pending = workers * 2
+  pending = deque()
+
+  with nullcontext(executor) if executor is not None else ProcessPoolExecutor(max_workers=workers) as pool:
+    for batch in batched(items, batch_size):
+      pending.append(pool.submit(func, batch))
+      if len(pending) >= max_pending:
+        yield from pending.popleft().result()
+
+    while pending:
+      yield from pending.popleft().result()
@@ -1,25 +1,31 @@
-import gzip
-import json
-import jsonlines
 import logging
 from os import getenv
+from codec import dumps_line, loads
+from compression import open_input, open_output
+from parallel import map_batches
 
 logger = logging.getLogger(__name__)
 
 
 def create_patch_from_products_fp(fp_in):
-  patch = []
+  return list(iter_patch_from_products_fp(fp_in))
 
-  with gzip.open(fp_in, "rb") as file:
+
+# stream over file and yield an add product operation for each product
+def iter_patch_from_products_fp(fp_in):
+  with open_input(fp_in) as file:
     for line in file:
-      patch.append(create_add_product_op(json.loads(line)))
-  
-  return patch
+      yield create_add_product_op(loads(line))
+
+
+# path of a product in patch operations
+def product_path(product_id):
+  return "/products/" + product_id.replace("/", "~1") # JSONPointer compliant replacement
 
 
 # construct an add product operation from shopify product
 def create_add_product_op(product):
-  path = "/products/" + product["id"].replace("/", "~1") # JSONPointer compliant replacement
+  path = product_path(product["id"])
  
   return {
     "op": "add", 
@@ -30,9 +36,30 @@ def create_add_product_op(product):
     }}
 
 
-def main(fp_in, fp_out):
-  patch = create_patch_from_products_fp(fp_in)
+# construct attribute level add operations for the named product and variant attributes of a product,
+#   which only update those attributes and leave the rest of the product as it is
+def create_attribute_ops(product, product_attributes, variant_attributes):
+  path = product_path(product["id"])
+
+  attributes = product["attributes"]
+  for name in product_attributes:
+    if name in attributes:
+      yield {"op": "add", "path": path + "/attributes/" + name, "value": attributes[name]}
+
+  for variant_id, variant in product["variants"].items():
+    variant_path = path + "/variants/" + variant_id.replace("/", "~1")
+    attributes = variant["attributes"]
+    for name in variant_attributes:
+      if name in attributes:
+        yield {"op": "add", "path": variant_path + "/attributes/" + name, "value": attributes[name]}
+
+
+# worker for parallel mode, builds and serializes the operations for a batch of raw input lines
+def create_add_product_op_lines(lines):
+  return [dumps_line(create_add_product_op(loads(line))) for line in lines]
+
 
+def main(fp_in, fp_out, workers=1, compression=None):
   from sys import stdout
   
   # Define logger
@@ -42,13 +69,19 @@ def main(fp_in, fp_out):
     level=loglevel,
     format="%(name)-12s %(asctime)s %(levelname)-8s %(filename)s:%(funcName)s %(message)s"
   )
+
+  if workers > 1:
+    with open_input(fp_in) as file, open_output(fp_out, compression) as out:
+      for line in map_batches(create_add_product_op_lines, file, workers):
+        out.write(line)
+    return
+
+  patch = iter_patch_from_products_fp(fp_in)
   
   # write JSONLines to stdout
-  with gzip.open(fp_out, "wb") as file:
-    writer = jsonlines.Writer(file)
+  with open_output(fp_out, compression) as file:
     for object in patch:
-      writer.write(object)
-    writer.close()
+      file.write(dumps_line(object))
 
 if __name__ == '__main__':
   import argparse
@@ -74,9 +107,27 @@ if __name__ == '__main__':
     required=not getenv("BR_OUTPUT_FILE")
   )
 
+  parser.add_argument(
+    "--workers",
+    help="Number of worker processes to build patch operations with. Output is identical to the default single process run.",
+    type=int,
+    default=int(getenv("BR_WORKERS", "1")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--compression",
+    help="Compression of the output file: gzip[:level], zstd[:level] or none. Defaults to gzip:6. The feed API only accepts gzip or uncompressed patches. The compression of the input file is detected automatically.",
+    type=str,
+    default=getenv("BR_COMPRESSION"),
+    required=False
+  )
+
   args = parser.parse_args()
   fp_in = args.input_file
   fp_out = args.output_file
+  workers = args.workers
+  compression = args.compression
 
-  main(fp_in, fp_out)
+  main(fp_in, fp_out, workers, compression)
   
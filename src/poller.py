@@ -0,0 +1,66 @@
+import logging
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+
+class PollCancelled(RuntimeError):
+  pass
+
+
+def poll(target, progress=None, expected_total=None, step=1, max_step=60, backoff=1.5, timeout=7200, name="job", cancel=None):
+  """
+  Calls target until it returns True, starting with short delays and backing off adaptively.
+
+  progress is an optional callable returning how far along the job is, e.g. a bulk operation objectCount.
+  While progress grows, its rate is logged, and when the expected_total is known the delay is set from the
+  estimated time to completion so the poll lands close to completion. Otherwise the delay grows by backoff
+  up to max_step.
+
+  cancel is an optional threading.Event, e.g. set when a job running alongside fails. Polling stops as soon as
+  it is set, raising a PollCancelled, instead of waiting for the job to complete.
+
+  Raises a TimeoutError when the target doesn't succeed within timeout seconds.
+  Returns a dict with the number of polls and the seconds spent polling.
+  """
+  start = monotonic()
+  first_sample = None
+  delay = step
+  polls = 0
+
+  while True:
+    if cancel is not None and cancel.is_set():
+      raise PollCancelled("%s was cancelled" % name)
+    polls += 1
+    if target():
+      seconds = monotonic() - start
+      logger.info("%s completed after %s polls in %.1fs", name, polls, seconds)
+      return {"polls": polls, "seconds": seconds}
+
+    now = monotonic()
+    if now - start > timeout:
+      raise TimeoutError("%s did not complete within %ss" % (name, timeout))
+
+    count = progress() if progress else None
+    rate = None
+    if count is not None:
+      if first_sample is None:
+        first_sample = (now, count)
+      elif now > first_sample[0]:
+        rate = (count - first_sample[1]) / (now - first_sample[0])
+
+    if rate and expected_total and count < expected_total:
+      eta = (expected_total - count) / rate
+      logger.info("%s progress: %s of ~%s at %.1f/s, estimated completion in %.0fs", name, count, expected_total, rate, eta)
+      # aim halfway to the estimate so an underestimated rate doesn't overshoot completion
+      delay = min(max(eta / 2, step), max_step)
+    else:
+      if rate:
+        logger.info("%s progress: %s at %.1f/s", name, count, rate)
+      delay = min(delay * backoff, max_step)
+
+    delay = min(delay, max(timeout - (now - start), 0))
+    if cancel is not None:
+      cancel.wait(delay)
+    else:
+      sleep(delay)
@@ -0,0 +1,122 @@
+import logging
+import re
+from functools import lru_cache
+from os import getenv, path
+from codec import loads
+
+logger = logging.getLogger(__name__)
+
+PROJECTIONS_DIR = path.join(path.dirname(path.abspath(__file__)), "projections")
+DEFAULT_PROJECTION_FP = path.join(PROJECTIONS_DIR, "default.json")
+
+FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# metafield fields the aggregation and metafield decoding rely on
+METAFIELD_FIELDS = ["id", "key", "value", "namespace", "type", "updatedAt"]
+
+
+@lru_cache(maxsize=None)
+def load_projection(projection_fp=None):
+  """
+  Reads a projection config once per process and returns the bulk query selecting its fields.
+  projection_fp defaults to BR_PROJECTION_FILE, then to the default projection.
+  """
+  projection_fp = projection_fp or getenv("BR_PROJECTION_FILE") or DEFAULT_PROJECTION_FP
+  with open(projection_fp, "rb") as file:
+    config = loads(file.read())
+
+  logger.info("Built bulk query from projection: %s", projection_fp)
+  return build_bulk_query(config)
+
+
+def build_bulk_query(config):
+  """
+  Builds the products bulk query from a projection config, so only the fields the catalog uses are exported.
+
+  The config lists the fields to export:
+    "product", "variant": fields of products and variants, with dotted paths for nested fields,
+                          e.g. "featuredImage.url". The id is always exported.
+    "collections": fields of the collections of products, none when missing or empty.
+                   "collections_query" optionally filters them, e.g. "published_status:published"
+    "product_metafields", "variant_metafields": "*" for every metafield, a list with a single namespace,
+                   or a list of namespace.key metafields. None when missing or empty.
+
+  Each exported field becomes the same sp./sv. attribute it always has, fields that aren't exported are left out.
+  """
+  product = ["id"] + config.get("product", [])
+  variant = ["id"] + config.get("variant", [])
+
+  selection = selection_tree(product)
+  if config.get("collections"):
+    arguments = {"query": config["collections_query"]} if config.get("collections_query") else {}
+    selection[connection("collections", arguments)] = connection_tree(["id"] + config["collections"])
+  add_metafields(selection, config.get("product_metafields"))
+
+  variant_selection = selection_tree(variant)
+  add_metafields(variant_selection, config.get("variant_metafields"))
+  selection["variants"] = connection_tree(variant_selection)
+
+  lines = []
+  render(lines, {"products": connection_tree(selection)}, 1)
+  return "{\n" + "\n".join(lines) + "\n}"
+
+
+# nests dotted field paths into a dict of field to its sub selection, None for scalars
+def selection_tree(fields):
+  tree = {}
+  for field in fields:
+    node = tree
+    names = field.split(".")
+    for i, name in enumerate(names):
+      if not FIELD_NAME.match(name):
+        raise ValueError("Invalid field in projection: %s" % field)
+      if i == len(names) - 1:
+        node.setdefault(name, None)
+      else:
+        if node.get(name) is None:
+          node[name] = {}
+        node = node[name]
+  return tree
+
+
+def connection_tree(fields):
+  return {"edges": {"node": fields if isinstance(fields, dict) else selection_tree(fields)}}
+
+
+def connection(name, arguments):
+  if not arguments:
+    return name
+  return "%s(%s)" % (name, ", ".join("%s:%s" % (k, quote(v)) for k, v in arguments.items()))
+
+
+def quote(value):
+  if isinstance(value, list):
+    return "[" + ", ".join(quote(v) for v in value) + "]"
+  return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+# bulk queries allow a single metafields connection per object, so the allowlist is pushed down as either
+#   the namespace argument or the keys argument of that connection
+def add_metafields(selection, allowlist):
+  if not allowlist:
+    return
+  if allowlist == "*":
+    arguments = {}
+  elif all("." in entry for entry in allowlist):
+    arguments = {"keys": list(allowlist)}
+  elif len(allowlist) == 1:
+    arguments = {"namespace": allowlist[0]}
+  else:
+    raise ValueError("Metafields must be \"*\", a single namespace or a list of namespace.key: %s" % allowlist)
+
+  selection[connection("metafields", arguments)] = connection_tree(METAFIELD_FIELDS)
+
+
+def render(lines, tree, indent):
+  for name, fields in tree.items():
+    if fields is None:
+      lines.append("  " * indent + name)
+    else:
+      lines.append("  " * indent + name + " {")
+      render(lines, fields, indent + 1)
+      lines.append("  " * indent + "}")
@@ -1,92 +1,221 @@
-import gzip
-import json
-import jsonlines
 import logging
-from collections import defaultdict
-from os import getenv
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from functools import partial
+from os import getenv, path
+from codec import dumps_line, loads
+from compression import open_input, open_output
+from parallel import map_batches
 
 logger = logging.getLogger(__name__)
 
-# iterate over shopify file and return a list of patch ops
-def parse_shopify_objects(fp):
-  objects = {}
-  parent_to_children = defaultdict(list)
-  products = []
 
-  # stream over file and index each object in bulk output
-  with gzip.open(fp, 'rb') as file:
+class OutOfOrderError(ValueError):
+  """
+  Raised by the streaming aggregator when a child object does not follow its parent product,
+  meaning products already emitted may be incomplete. Callers restart with the spilled index.
+  """
+  pass
+
+
+# bulk output is read from a file path, or from a callable returning an iterable of raw lines
+#   such as a streamed download, which is called again should the spilled index fallback be needed
+@contextmanager
+def open_lines(fp):
+  if callable(fp):
+    yield fp()
+  else:
+    with open_input(fp) as file:
+      yield file
+
+
+def consume_products(fp, consume, consume_lines=None, spill_dir=None, timings=None):
+  """
+  Streams the aggregated products of the bulk output, or of a callable streaming its lines, into consume and
+  returns its result. When consume_lines is passed, it is streamed the raw lines of each product instead,
+  to aggregate them elsewhere such as in worker processes.
+
+  Should the bulk output turn out not to be ordered parent-then-children, consume is called again with the products
+  of the spilled index, so it has to start over rather than add to what it did, and the timings of the first pass are cleared.
+  """
+  try:
+    if consume_lines is not None:
+      return consume_lines(iter_product_lines(fp))
+    return consume(iter_shopify_products(fp))
+  except OutOfOrderError as e:
+    logger.warning("%s, falling back to spilled index", e)
+    if timings is not None:
+      timings.clear()
+    return consume(iter_shopify_products_spilled(fp, spill_dir=spill_dir))
+
+
+# iterate over shopify file and return a list of aggregated products
+def parse_shopify_objects(fp, spill_dir=None):
+  return consume_products(fp, list, spill_dir=spill_dir)
+
+
+# stream over the bulk output and emit each aggregated product as soon as the next product starts
+#   Shopify bulk output lists every child object (collections, metafields, variants and their metafields)
+#   after its parent product and before the next product, so only a single product is held in memory
+def iter_shopify_products(fp):
+  for lines in iter_product_lines(fp):
+    yield create_product_from_lines(lines)
+
+
+# split the bulk output into the raw lines of each product without parsing them
+#   a top-level product line is the only kind without a __parentId key, a line misjudged here
+#   is caught by create_product_from_lines
+def iter_product_lines(fp):
+  lines = []
+  with open_lines(fp) as file:
     for line in file:
-      index_object(json.loads(line), objects, parent_to_children)
+      if lines and b'"__parentId"' not in line:
+        yield lines
+        lines = []
+      lines.append(line)
+
+  if lines:
+    yield lines
+
+
+# constructs an aggregated product from the raw lines of a single product
+def create_product_from_lines(lines):
+  product = loads(lines[0])
+  if "__parentId" in product:
+    raise OutOfOrderError("Bulk output object %s does not follow its parent %s" % (product["id"], product["__parentId"]))
+
+  index = ProductIndex(product)
+  for line in lines[1:]:
+    index.add(loads(line))
+
+  return index.create_product()
+
+
+# worker for parallel mode, aggregates and serializes a batch of products
+def create_product_lines(batch):
+  return [dumps_line(create_product_from_lines(lines)) for lines in batch]
 
-    # iterate over all objects and constructs an aggregated product
-    for k in objects.keys():
-      if "/Product/" in k and "/Collection/" not in k:
-        product = create_product_from_objects(k, objects, parent_to_children)
-        products.append(product)
 
-  return products
+GID_PREFIX = "gid://shopify/"
 
 
-# process each shopify file object and load data into memory for later lookups
-def index_object(shopify_object, objects, parent_to_children):
-  shopify_id = shopify_object["id"]
+# parses a GID such as gid://shopify/ProductVariant/123 into its kind and numeric id, ("ProductVariant", 123)
+#   ids that aren't numeric are kept as strings
+def parse_gid(gid):
+  kind, _, number = gid[len(GID_PREFIX):].partition("/")
+  return kind, int(number) if number.isdigit() else number
 
-  # Collection IDs are not globally unique so need to combine with __parentId
-  if "/shopify/Collection/" in shopify_id:
-    shopify_id = shopify_object["id"] + shopify_object["__parentId"]
 
-  objects[shopify_id] = shopify_object
+def gid_kind(gid):
+  return gid[len(GID_PREFIX):gid.index("/", len(GID_PREFIX))]
 
-  if "__parentId" in shopify_object:
-    parent_to_children[shopify_object["__parentId"]].append(shopify_id)
 
+# fallback for bulk output that isn't ordered parent-then-children
+#   every line is spilled into an on disk sqlite index, products into a table of their own and children
+#   into a table keyed by the parsed (kind, numeric id) of their parent, then each product is rebuilt
+#   from its own rows so memory stays bounded by the largest product
+def iter_shopify_products_spilled(fp, spill_dir=None):
+  with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+    db = sqlite3.connect(path.join(tmp_dir, "shopify_objects.sqlite"))
+    try:
+      db.execute("CREATE TABLE products (seq INTEGER PRIMARY KEY, number, line BLOB)")
+      db.execute("CREATE TABLE children (seq INTEGER PRIMARY KEY, parent_kind TEXT, parent_number, kind TEXT, number, line BLOB)")
 
-# constructs an aggregated product from it's children objects
-def create_product_from_objects(k, objects, parent_to_children):
-  collections, variants, metafields = [], [], []
+      with open_lines(fp) as file:
+        for seq, line in enumerate(file):
+          shopify_object = loads(line)
+          kind, number = parse_gid(shopify_object["id"])
+          parent_id = shopify_object.get("__parentId")
+          if parent_id is not None:
+            db.execute("INSERT INTO children VALUES (?, ?, ?, ?, ?, ?)", (seq, *parse_gid(parent_id), kind, number, line))
+          elif kind == "Product":
+            db.execute("INSERT INTO products VALUES (?, ?, ?)", (seq, number, line))
 
-  children_ids = parent_to_children[k]
-  for child_id in children_ids:
-    if "/Collection/" in child_id:
-      collections.append(objects[child_id])
-    elif "/ProductVariant/" in child_id:
-      variants.append(create_variant(child_id, objects, parent_to_children))
-    elif "/Metafield/" in child_id:
-      if "/Product/" in objects[child_id]["__parentId"]:
-        metafields.append(objects[child_id])
+      db.execute("CREATE INDEX children_parent ON children (parent_kind, parent_number)")
+      db.commit()
 
-  product = objects[k]
-  product["collections"] = collections
-  product["variants"] = variants
-  product["metafields"] = metafields
+      products = db.execute("SELECT number, line FROM products ORDER BY seq")
+      for product_number, line in products:
+        index = ProductIndex(loads(line))
 
-  return product
+        # products only nest two levels deep: product -> variant -> metafield
+        parents = [("Product", product_number)]
+        while parents:
+          parent = parents.pop(0)
+          children = db.execute("SELECT kind, number, line FROM children WHERE parent_kind = ? AND parent_number = ? ORDER BY seq", parent)
+          for kind, number, child_line in children.fetchall():
+            index.add(loads(child_line))
+            if kind == "ProductVariant":
+              parents.append((kind, number))
 
+        yield index.create_product()
+    finally:
+      db.close()
 
-# constructs the variants for a product
-def create_variant(variant_id, objects, parent_to_children):
-  metafields = []
 
-  children_ids = parent_to_children[variant_id]
-  for child_id in children_ids:
-    if "/Metafield/" in child_id:
-      if "/ProductVariant/" in objects[child_id]["__parentId"]:
-        metafields.append(objects[child_id])
+class ProductIndex:
+  """
+  Index of the objects of a single product, with a list per object kind and the variants by id.
+  Children are routed by the kind parsed from their GID, and must follow their parent, otherwise an
+  OutOfOrderError is raised. GIDs are kept as strings, so the 1_shopify_products output is unchanged.
+  """
 
-  variant = objects[variant_id]
-  variant["metafields"] = metafields
-  return variant
+  def __init__(self, product):
+    self.product = product
+    self.collections = []
+    self.metafields = []
+    # variant id to variant, each variant collects its own metafields
+    self.variants = {}
 
+  def add(self, shopify_object):
+    parent_id = shopify_object.get("__parentId")
+    shopify_id = shopify_object["id"]
+    product_id = self.product["id"]
+    kind = gid_kind(shopify_id)
 
-def main(fp_in, fp_out):
-  products = parse_shopify_objects(fp_in)
+    if parent_id == product_id:
+      if kind == "Collection":
+        self.collections.append(shopify_object)
+      elif kind == "ProductVariant":
+        shopify_object["metafields"] = []
+        self.variants[shopify_id] = shopify_object
+      elif kind == "Metafield":
+        self.metafields.append(shopify_object)
+    elif parent_id in self.variants:
+      if kind == "Metafield":
+        self.variants[parent_id]["metafields"].append(shopify_object)
+    else:
+      raise OutOfOrderError("Bulk output object %s does not follow its parent %s" % (shopify_id, parent_id))
 
-  # write JSONLines to stdout
-  with gzip.open(fp_out, "wb") as out:
-    writer = jsonlines.Writer(out)
+  # constructs the aggregated product from its children
+  def create_product(self):
+    product = self.product
+    product["collections"] = self.collections
+    product["variants"] = list(self.variants.values())
+    product["metafields"] = self.metafields
+    return product
+
+
+def write_products(products, fp_out, compression=None):
+  with open_output(fp_out, compression) as out:
     for object in products:
-      writer.write(object)
-    writer.close()
+      out.write(dumps_line(object))
+
+
+def write_product_lines(product_lines, fp_out, workers, compression=None):
+  with open_output(fp_out, compression) as out:
+    for line in map_batches(create_product_lines, product_lines, workers):
+      out.write(line)
+
+
+def main(fp_in, fp_out, spill_dir=None, workers=1, compression=None):
+  # stream products straight to the output file, rewriting it from the spilled index
+  # should the bulk output turn out not to be ordered
+  consume_products(fp_in,
+                   partial(write_products, fp_out=fp_out, compression=compression),
+                   consume_lines=partial(write_product_lines, fp_out=fp_out, workers=workers, compression=compression) if workers > 1 else None,
+                   spill_dir=spill_dir)
 
 
 if __name__ == '__main__':
@@ -124,8 +253,35 @@ if __name__ == '__main__':
     required=not getenv("BR_OUTPUT_FILE")
   )
 
+  parser.add_argument(
+    "--spill-dir",
+    help="Directory for the temporary on disk index used when the bulk output isn't ordered parent-then-children. Defaults to the system temp directory.",
+    type=str,
+    default=getenv("BR_SPILL_DIR"),
+    required=False
+  )
+
+  parser.add_argument(
+    "--workers",
+    help="Number of worker processes to aggregate products with. Output is identical to the default single process run.",
+    type=int,
+    default=int(getenv("BR_WORKERS", "1")),
+    required=False
+  )
+
+  parser.add_argument(
+    "--compression",
+    help="Compression of the output file: gzip[:level], zstd[:level] or none. Defaults to gzip:6. The compression of the input file is detected automatically.",
+    type=str,
+    default=getenv("BR_COMPRESSION"),
+    required=False
+  )
+
   args = parser.parse_args()
   fp_in = args.input_file
   fp_out = args.output_file
+  spill_dir = args.spill_dir
+  workers = args.workers
+  compression = args.compression
 
-  main(fp_in, fp_out)
+  main(fp_in, fp_out, spill_dir, workers, compression)
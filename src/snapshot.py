@@ -0,0 +1,63 @@
+import logging
+import sqlite3
+from codec import dumps_line, loads
+
+logger = logging.getLogger(__name__)
+
+
+# persistent local snapshot of aggregated shopify products, keyed by shopify product id
+#   products keep the position they were first added in, so a rebuilt patch has a stable order
+def open_snapshot(snapshot_fp):
+  db = sqlite3.connect(snapshot_fp)
+  db.execute("CREATE TABLE IF NOT EXISTS products (id TEXT PRIMARY KEY, line BLOB)")
+  db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+  db.commit()
+  return db
+
+
+def get_meta(db, key):
+  row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+  return row[0] if row else None
+
+
+def set_meta(db, key, value):
+  db.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, value))
+
+
+def merge_products(db, products):
+  """
+  Inserts or replaces aggregated products in the snapshot, returning the number of products merged.
+  Changes aren't committed so they can be committed together with the run's metadata.
+  """
+  count = 0
+  for product in products:
+    db.execute(
+      "INSERT INTO products (id, line) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET line = excluded.line",
+      (product["id"], dumps_line(product)))
+    count += 1
+
+  logger.info("Merged %s changed products into snapshot", count)
+  return count
+
+
+# deletes every product that isn't in the ids of live products, returning the number deleted
+def reconcile_products(db, product_ids):
+  db.execute("CREATE TEMP TABLE IF NOT EXISTS live_products (id TEXT PRIMARY KEY)")
+  db.execute("DELETE FROM live_products")
+  db.executemany("INSERT OR IGNORE INTO live_products (id) VALUES (?)", ((product_id,) for product_id in product_ids))
+  deleted = db.execute("DELETE FROM products WHERE id NOT IN (SELECT id FROM live_products)").rowcount
+  db.execute("DELETE FROM live_products")
+
+  logger.info("Deleted %s products from snapshot that no longer exist in the shop", deleted)
+  return deleted
+
+
+# raw aggregated product lines in snapshot order
+def iter_product_lines(db):
+  for (line,) in db.execute("SELECT line FROM products ORDER BY rowid"):
+    yield line
+
+
+def iter_products(db):
+  for line in iter_product_lines(db):
+    yield loads(line)
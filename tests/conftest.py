@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# modules live flat in src/ and import each other by bare name, as when run as scripts
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "src"))
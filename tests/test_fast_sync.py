@@ -0,0 +1,57 @@
+import gzip
+import json
+
+import main
+
+
+def write_bulk(fp, price):
+  lines = [
+    {"id": "gid://shopify/Product/1", "handle": "p1", "title": "Product 1", "status": "ACTIVE", "totalInventory": 3},
+    {"id": "gid://shopify/ProductVariant/11", "sku": "s1", "price": price, "compareAtPrice": None,
+     "inventoryQuantity": 3, "availableForSale": True, "__parentId": "gid://shopify/Product/1"},
+  ]
+  with gzip.open(fp, "wt") as file:
+    file.writelines(json.dumps(line) + "\n" for line in lines)
+
+
+def read_ops(fp):
+  with gzip.open(fp, "rt") as file:
+    return [json.loads(line) for line in file]
+
+
+def test_fast_sync_after_full_run_sends_price_going_back(tmp_path, monkeypatch):
+  bulk_fp = str(tmp_path / "bulk.jsonl.gz")
+  exports = iter(range(1, 100))
+  sent = []
+
+  def export(*args, **kwargs):
+    kwargs["stats"].update({"objectCount": 2})
+    return bulk_fp, str(next(exports))
+
+  def patch_catalog(fp, **kwargs):
+    sent.append(read_ops(fp))
+
+  monkeypatch.setattr(main, "export_shopify_jsonl", export)
+  monkeypatch.setattr(main, "patch_catalog", patch_catalog)
+  settings = {"shopify_url": "shop.myshopify.com", "br_catalog_name": "c", "output_dir": str(tmp_path), "delta": True}
+
+  def sent_prices():
+    return [op["value"] for op in sent[-1] if op["path"].endswith("/attributes/sv.price")]
+
+  # a full run establishes the product index, then fast syncs send price A
+  write_bulk(bulk_fp, "10.00")
+  main.main(**settings)
+  main.main(fast_sync=True, **settings)
+  assert sent_prices() == ["10.00"]
+
+  # a full run sends price B
+  write_bulk(bulk_fp, "12.00")
+  main.main(**settings)
+  assert sent[-1][0]["value"]["variants"]["s1"]["attributes"]["sv.price"] == "12.00"
+
+  # price A again has to be sent by the fast sync, the catalog holds B
+  write_bulk(bulk_fp, "10.00")
+  count = len(sent)
+  main.main(fast_sync=True, **settings)
+  assert len(sent) == count + 1
+  assert sent_prices() == ["10.00"]
@@ -0,0 +1,236 @@
+import gzip
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import feed
+import graphql
+from compression import open_input
+
+
+# serves a handler class on a free local port, yielding its base url
+@contextmanager
+def serve(handler):
+  server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  try:
+    yield "http://127.0.0.1:%s" % server.server_port
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+  def log_message(self, *args):
+    pass
+
+  def send(self, status, body=b"", content_type="application/json"):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def read_body(self):
+    return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+
+# a stand-in of the Bloomreach feed API, see --br-api-url
+#   parts whose operations contain a marker of responses are answered with its statuses in turn, then with 200
+class FeedApi(LocalHandler):
+  responses = {}
+  delays = {}
+  acknowledged = []
+  lock = threading.Lock()
+
+  def do_PATCH(self):
+    body = gzip.decompress(self.read_body())
+    ops = [json.loads(line)["path"] for line in body.splitlines()]
+
+    for marker, seconds in self.delays.items():
+      if marker in ops:
+        time.sleep(seconds)
+    for marker, statuses in self.responses.items():
+      if marker in ops and statuses:
+        return self.send(statuses.pop(0))
+
+    with self.lock:
+      self.acknowledged.append(ops)
+      job_id = "job%s" % len(self.acknowledged)
+    self.send(200, json.dumps({"jobId": job_id}).encode())
+
+  def do_GET(self):
+    self.send(200, json.dumps({"status": "success"}).encode())
+
+
+def write_patch(fp, products):
+  with gzip.open(fp, "wt") as file:
+    for i in range(products):
+      file.write(json.dumps({"op": "add", "path": "/products/p%s" % i, "value": {"attributes": {"title": "Product %s" % i}}}) + "\n")
+
+
+def test_chunked_patch_retries_and_resumes_from_checkpoint(tmp_path, monkeypatch):
+  monkeypatch.setattr(feed, "sleep", lambda seconds: None)
+  monkeypatch.setattr(FeedApi, "acknowledged", [])
+  # the first part is slow to answer, so it is still in flight when the third part fails, the second is retried once
+  monkeypatch.setattr(FeedApi, "delays", {"/products/p0": 0.5})
+  monkeypatch.setattr(FeedApi, "responses", {"/products/p5": [503], "/products/p10": [400]})
+
+  patch_fp = str(tmp_path / "patch.jsonl.gz")
+  write_patch(patch_fp, 40)
+  settings = {"account_id": "1", "catalog_name": "c", "token": "t", "delta": True, "chunk_bytes": 400, "concurrency": 2,
+              "checkpoint_dir": str(tmp_path)}
+
+  with serve(FeedApi) as api_url:
+    with pytest.raises(requests.HTTPError):
+      feed.patch_catalog(patch_fp, api_url=api_url, **settings)
+    (checkpoint_fp,) = tmp_path.glob("feed_checkpoint_*.json")
+    checkpointed = len(json.loads(checkpoint_fp.read_text())["jobs"])
+    # every part answered with a job id is checkpointed, including the one in flight when the other failed
+    assert checkpointed == len(FeedApi.acknowledged)
+    assert ["/products/p0" in ops for ops in FeedApi.acknowledged].count(True) == 1
+
+    first_run = len(FeedApi.acknowledged)
+    feed.patch_catalog(patch_fp, api_url=api_url, **settings)
+
+  # the rerun only sends the parts missing from the checkpoint, so every operation is acknowledged once
+  sent = [path for ops in FeedApi.acknowledged for path in ops]
+  assert sorted(sent) == sorted("/products/p%s" % i for i in range(40))
+  assert len(FeedApi.acknowledged) > first_run
+  assert not list(tmp_path.glob("feed_checkpoint_*.json"))
+
+
+# a stand-in of the Shopify Admin API bulk operations, see --shopify-api-url
+#   every bulk operation completes on its first poll, except those listed in fail_jobs, whose
+#   partial data is the first partial_bytes of their output, current is the current bulk operation
+class AdminApi(LocalHandler):
+  products = []
+  jobs = []
+  fail_jobs = set()
+  partial_bytes = 0
+  current = None
+  lock = threading.Lock()
+
+  def do_GET(self):
+    number = int(self.path.split("/")[-1].split("?")[0])
+    data = self.jobs[number]["data"]
+    if self.path.endswith("?partial"):
+      data = data[:self.partial_bytes]
+    self.send(200, data, "application/jsonl")
+
+  def do_POST(self):
+    request = json.loads(self.read_body())
+    operation = request["operationName"]
+    if operation == "ProductIdBounds":
+      edges = lambda number: {"edges": [{"node": {"id": "gid://shopify/Product/%s" % number}}]}
+      return self.reply({"first": edges(self.products[0][0]), "last": edges(self.products[-1][0])})
+    if operation == "CurrentJob":
+      return self.reply({"currentBulkOperation": self.current})
+    if operation == "GetJob":
+      job_id = request["variables"]["job_id"]
+      return self.reply({"node": self.job_node(job_id, int(job_id.split("/")[-1]))})
+
+    # the id range of an ExportDataJob, e.g. products(query:"id:>=5 AND id:<10")
+    terms = re.search(r'products\(query:"([^"]*)"\)', request["query"])
+    terms = terms.group(1).split(" AND ") if terms else []
+    low = next((int(term[5:]) for term in terms if term.startswith("id:>=")), None)
+    high = next((int(term[4:]) for term in terms if term.startswith("id:<")), None)
+    lines = [line for number, product_lines in self.products
+             if (low is None or number >= low) and (high is None or number < high)
+             for line in product_lines]
+    with self.lock:
+      self.jobs.append({"range": (low, high), "data": b"".join(lines), "count": len(lines)})
+      number = len(self.jobs) - 1
+    self.reply({"bulkOperationRunQuery": {"bulkOperation": {"id": "gid://shopify/BulkOperation/%s" % number, "status": "CREATED"}}})
+
+  def job_node(self, job_id, number):
+    url = "http://127.0.0.1:%s/files/%s" % (self.server.server_port, number)
+    node = {"id": job_id, "status": "COMPLETED", "objectCount": str(self.jobs[number]["count"]),
+            "completedAt": "2026-01-01T00:00:00Z", "url": url}
+    if number in self.fail_jobs:
+      node.update({"status": "FAILED", "errorCode": "INTERNAL_SERVER_ERROR", "url": None, "partialDataUrl": url + "?partial"})
+    return node
+
+  def reply(self, data):
+    self.send(200, json.dumps({"data": data}).encode())
+
+
+# the bulk output of products with numeric ids, each followed by a variant and a metafield of the variant
+def create_bulk_products(numbers):
+  products = []
+  for number in numbers:
+    product_id = "gid://shopify/Product/%s" % number
+    variant_id = "gid://shopify/ProductVariant/%s" % (number * 10)
+    objects = [
+      {"id": product_id, "handle": "p%s" % number, "title": "Product %s" % number},
+      {"id": variant_id, "sku": "s%s" % number, "__parentId": product_id},
+      {"id": "gid://shopify/Metafield/%s" % (number * 10), "key": "k", "value": "v", "__parentId": variant_id},
+    ]
+    products.append((number, [json.dumps(shopify_object).encode() + b"\n" for shopify_object in objects]))
+  return products
+
+
+def export(api_url, output_dir, **kwargs):
+  stats = {}
+  jsonl_fp, _ = graphql.get_products_jsonl_fp("shop.myshopify.com", "2026-01", "t", str(output_dir), stats=stats,
+                                              api_url=api_url + "/admin/api/2026-01", compression="gzip", **kwargs)
+  with open_input(jsonl_fp) as file:
+    return file.read(), stats
+
+
+def test_sharded_export_merges_shards_in_product_id_order(tmp_path, monkeypatch):
+  products = create_bulk_products(range(100, 130))
+  monkeypatch.setattr(AdminApi, "products", products)
+  monkeypatch.setattr(AdminApi, "jobs", [])
+
+  with serve(AdminApi) as api_url:
+    data, stats = export(api_url, tmp_path, shards=3)
+
+  assert {job["range"] for job in AdminApi.jobs} == {(None, 110), (110, 120), (120, None)}
+  assert data == b"".join(line for _, lines in products for line in lines)
+  assert stats["shards"] == 3 and stats["objectCount"] == 90
+  # the downloaded shard files are removed once merged
+  assert [fp.name for fp in tmp_path.iterdir()] == ["0_shopify_bulk_op.jsonl.gz"]
+
+
+def test_failed_export_resumes_from_partial_data(tmp_path, monkeypatch):
+  products = create_bulk_products(range(100, 110))
+  expected = b"".join(line for _, lines in products for line in lines)
+  monkeypatch.setattr(AdminApi, "products", products)
+  monkeypatch.setattr(AdminApi, "jobs", [])
+  monkeypatch.setattr(AdminApi, "fail_jobs", {0})
+  # the partial data stops in the middle of the variant of product 104
+  monkeypatch.setattr(AdminApi, "partial_bytes", expected.index(b'"s104"'))
+
+  with serve(AdminApi) as api_url:
+    data, stats = export(api_url, tmp_path, resume_attempts=1)
+
+  # product 104 may be missing children, so it is dropped from the partial data and exported again
+  assert [job["range"] for job in AdminApi.jobs] == [(None, None), (104, None)]
+  assert data == expected
+  assert stats["resumes"] == 1
+  assert (tmp_path / "0_shopify_bulk_op.shard0.partial0.jsonl.gz").exists()
+
+
+def test_export_attaches_to_running_operation_of_the_same_query(tmp_path, monkeypatch):
+  products = create_bulk_products(range(100, 105))
+  data = b"".join(line for _, lines in products for line in lines)
+  monkeypatch.setattr(AdminApi, "products", products)
+  monkeypatch.setattr(AdminApi, "jobs", [{"range": (None, None), "data": data, "count": 15}])
+  monkeypatch.setattr(AdminApi, "current", {"id": "gid://shopify/BulkOperation/0", "status": "RUNNING",
+                                          "query": graphql.BULK_QUERY.search(graphql.build_export_query()).group(1)})
+
+  with serve(AdminApi) as api_url:
+    exported, stats = export(api_url, tmp_path)
+
+  # no operation is submitted
+  assert len(AdminApi.jobs) == 1
+  assert exported == data
+  assert stats["attached"]